@@ -154,15 +154,11 @@ class ModelLoader:
                 use_cache=True,  # Enable KV cache for faster generation
             )
         
-        # Decode output
+        # Decode only the new tokens, not the echoed prompt
         generated_text = self.tokenizer.decode(
-            outputs[0],
+            outputs[0, inputs["input_ids"].shape[1]:],
             skip_special_tokens=True
-        )
-        
-        # Remove prompt from output
-        if generated_text.startswith(prompt):
-            generated_text = generated_text[len(prompt):].strip()
+        ).strip()
         
         return generated_text
     
@@ -4,41 +4,95 @@ Same code as Phase 1, deployed to Kubernetes with GPU scheduling
 """
 
 from fastapi import FastAPI, HTTPException
-from fastapi.responses import StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel, Field
 from typing import Optional, AsyncIterator
 from contextlib import asynccontextmanager
+from prometheus_client import Counter, Histogram, make_asgi_app
+from pythonjsonlogger import jsonlogger
 import torch
-from model_loader import ModelLoader
+from model_loader import BatchedEngine, ModelLoader
+import itertools
 import logging
+import os
+import sys
 import time
-import json
+import orjson
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+
+class SampleFilter(logging.Filter):
+    """Pass one in every `rate` records below WARNING; warnings and errors always pass"""
+    
+    def __init__(self, rate: int):
+        super().__init__()
+        self.rate = max(rate, 1)
+        self._counter = itertools.count()
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno >= logging.WARNING or next(self._counter) % self.rate == 0
+
+
+# Configure logging (LOG_FORMAT=json for structured logs)
+log_handler = logging.StreamHandler(sys.stdout)
+if os.getenv("LOG_FORMAT", "text") == "json":
+    log_handler.setFormatter(jsonlogger.JsonFormatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+logging.basicConfig(level=logging.INFO, handlers=[log_handler])
 logger = logging.getLogger(__name__)
 
-# Global model loader (initialized on startup)
+# Per-request logs are sampled; exact counts come from the Prometheus metrics
+request_logger = logging.getLogger(f"{__name__}.requests")
+request_logger.addFilter(SampleFilter(int(os.getenv("REQUEST_LOG_SAMPLE_RATE", "100"))))
+
+# Prometheus metrics (exposed on /metrics)
+REQUESTS = Counter("llm_requests_total", "Generation requests", ["status"])
+TOKENS_GENERATED = Counter("llm_generated_tokens_total", "Tokens generated")
+INFERENCE_SECONDS = Histogram(
+    "llm_inference_seconds",
+    "Generation latency",
+    buckets=(0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32, 64)
+)
+
+# Static GPU properties, looked up once instead of on every request
+# (only allocated/reserved memory needs to be live)
+_GPU_AVAILABLE = torch.cuda.is_available()
+_GPU_NAME = torch.cuda.get_device_name(0) if _GPU_AVAILABLE else None
+_GPU_TOTAL = torch.cuda.get_device_properties(0).total_memory if _GPU_AVAILABLE else 0
+
+# Global model loader and batching engine (initialized on startup)
 model_loader: Optional[ModelLoader] = None
+engine: Optional[BatchedEngine] = None
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Lifespan event handler for startup and shutdown"""
-    global model_loader
+    global model_loader, engine
     
     # Startup
     logger.info("Starting LLM Inference Server...")
-    logger.info(f"CUDA available: {torch.cuda.is_available()}")
+    logger.info(f"CUDA available: {_GPU_AVAILABLE}")
     
-    if torch.cuda.is_available():
-        logger.info(f"GPU: {torch.cuda.get_device_name(0)}")
-        logger.info(f"GPU Memory: {torch.cuda.get_device_properties(0).total_memory / 1024**3:.1f} GB")
+    if _GPU_AVAILABLE:
+        logger.info(f"GPU: {_GPU_NAME}")
+        logger.info(f"GPU Memory: {_GPU_TOTAL / 1024**3:.1f} GB")
     else:
         logger.warning("No GPU detected! This will be very slow.")
     
     try:
-        model_loader = ModelLoader(model_path="/app/model")
+        kv_quant = os.getenv("KV_QUANT", "false").lower() in ("1", "true", "yes")
+        model_loader = ModelLoader(
+            model_path="/app/model",
+            kv_quant=kv_quant,
+            quantization=os.getenv("QUANTIZATION", "none"),
+            compile_model=os.getenv("COMPILE_MODEL", "false").lower() in ("1", "true", "yes"),
+            draft_model_path=os.getenv("DRAFT_MODEL_PATH")
+        )
+        # The INT8 KV cache takes half the memory per sequence, so twice as many fit
+        engine = BatchedEngine(
+            model_loader,
+            max_batch_size=int(os.getenv("MAX_BATCH_SIZE", "32" if kv_quant else "16"))
+        )
         logger.info("Model loaded successfully!")
     except Exception as e:
         logger.error(f"Failed to load model: {e}")
@@ -47,6 +101,8 @@ async def lifespan(app: FastAPI):
     yield
     
     # Shutdown
+    if engine:
+        engine.close()
     if model_loader:
         del model_loader
         torch.cuda.empty_cache()
@@ -58,8 +114,10 @@ app = FastAPI(
     title="LLM Inference API",
     description="GPU-accelerated text generation with Llama 3.2 3B",
     version="1.0.0",
+    default_response_class=ORJSONResponse,
     lifespan=lifespan
 )
+app.mount("/metrics", make_asgi_app())
 
 
 class GenerateRequest(BaseModel):
@@ -87,8 +145,8 @@ async def root():
     return {
         "status": "healthy",
         "model_loaded": model_loader is not None,
-        "gpu_available": torch.cuda.is_available(),
-        "gpu_name": torch.cuda.get_device_name(0) if torch.cuda.is_available() else None
+        "gpu_available": _GPU_AVAILABLE,
+        "gpu_name": _GPU_NAME
     }
 
 
@@ -99,12 +157,12 @@ async def health():
         raise HTTPException(status_code=503, detail="Model not loaded")
     
     gpu_stats = {}
-    if torch.cuda.is_available():
+    if _GPU_AVAILABLE:
         gpu_stats = {
-            "gpu_name": torch.cuda.get_device_name(0),
+            "gpu_name": _GPU_NAME,
             "gpu_memory_allocated_gb": torch.cuda.memory_allocated(0) / 1024**3,
             "gpu_memory_reserved_gb": torch.cuda.memory_reserved(0) / 1024**3,
-            "gpu_memory_total_gb": torch.cuda.get_device_properties(0).total_memory / 1024**3
+            "gpu_memory_total_gb": _GPU_TOTAL / 1024**3
         }
     
     return {
@@ -118,31 +176,46 @@ async def health():
 async def generate(request: GenerateRequest):
     """Generate text from prompt"""
     
-    if not model_loader:
+    if not engine:
         raise HTTPException(status_code=503, detail="Model not loaded")
     
     try:
         start_time = time.time()
         
-        # Generate text
-        generated_text = model_loader.generate(
-            prompt=request.prompt,
-            max_tokens=request.max_tokens,
-            temperature=request.temperature,
-            top_p=request.top_p
-        )
+        if model_loader.draft_model is not None:
+            # Speculative decoding works on one sequence at a time
+            generated_text, tokens_generated = await run_in_threadpool(
+                model_loader.generate,
+                prompt=request.prompt,
+                max_tokens=request.max_tokens,
+                temperature=request.temperature,
+                top_p=request.top_p
+            )
+        else:
+            # Generate text (batched with other in-flight requests)
+            generated_text, tokens_generated = await engine.submit(
+                prompt=request.prompt,
+                max_tokens=request.max_tokens,
+                temperature=request.temperature,
+                top_p=request.top_p
+            )
         
         end_time = time.time()
         inference_time = (end_time - start_time) * 1000  # Convert to ms
         
         # Get GPU stats
-        gpu_name = torch.cuda.get_device_name(0) if torch.cuda.is_available() else "CPU"
-        gpu_memory_gb = torch.cuda.memory_allocated(0) / 1024**3 if torch.cuda.is_available() else 0
-        
-        # Count tokens (approximate)
-        tokens_generated = len(generated_text.split())
+        gpu_name = _GPU_NAME or "CPU"
+        gpu_memory_gb = torch.cuda.memory_allocated(0) / 1024**3 if _GPU_AVAILABLE else 0
         
-        logger.info(f"Generated {tokens_generated} tokens in {inference_time:.0f}ms")
+        REQUESTS.labels(status="success").inc()
+        TOKENS_GENERATED.inc(tokens_generated)
+        INFERENCE_SECONDS.observe(inference_time / 1000)
+        request_logger.info(
+            "Generated %d tokens in %.0fms",
+            tokens_generated,
+            inference_time,
+            extra={"tokens_generated": tokens_generated, "inference_time_ms": inference_time}
+        )
         
         return GenerateResponse(
             generated_text=generated_text,
@@ -154,39 +227,58 @@ async def generate(request: GenerateRequest):
         )
         
     except Exception as e:
-        logger.error(f"Generation failed: {e}")
+        REQUESTS.labels(status="error").inc()
+        logger.error("Generation failed: %s", e)
         raise HTTPException(status_code=500, detail=f"Generation failed: {str(e)}")
 
 
 @app.post("/generate-stream")
 async def generate_stream(request: GenerateRequest):
-    """Generate text with streaming response (future enhancement)"""
+    """Generate text as a Server-Sent Events stream, one event per decoded piece"""
     
     if not model_loader:
         raise HTTPException(status_code=503, detail="Model not loaded")
     
-    # For now, return non-streaming response
-    # Streaming implementation would require TextIteratorStreamer from transformers
-    return await generate(request)
+    def event_stream():
+        tokens = model_loader.generate_stream(
+            prompt=request.prompt,
+            max_tokens=request.max_tokens,
+            temperature=request.temperature,
+            top_p=request.top_p
+        )
+        try:
+            for token in tokens:
+                yield b"data: " + orjson.dumps({'token': token}) + b"\n\n"
+        except Exception as e:
+            # Headers are already sent, so report the failure in-band
+            logger.error("Streaming generation failed: %s", e)
+            yield b"data: " + orjson.dumps({'error': f"Generation failed: {str(e)}"}) + b"\n\n"
+        finally:
+            # Runs on client disconnect too, which stops the generate thread
+            tokens.close()
+        yield b"data: [DONE]\n\n"
+    
+    # Sync generator: Starlette iterates it in a worker thread
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
 
 
 @app.get("/stats")
 async def stats():
     """Get GPU statistics"""
     
-    if not torch.cuda.is_available():
+    if not _GPU_AVAILABLE:
         return {"error": "No GPU available"}
     
     return {
-        "gpu_name": torch.cuda.get_device_name(0),
+        "gpu_name": _GPU_NAME,
         "gpu_count": torch.cuda.device_count(),
         "cuda_version": torch.version.cuda,
         "pytorch_version": torch.__version__,
         "memory": {
             "allocated_gb": torch.cuda.memory_allocated(0) / 1024**3,
             "reserved_gb": torch.cuda.memory_reserved(0) / 1024**3,
-            "total_gb": torch.cuda.get_device_properties(0).total_memory / 1024**3,
-            "free_gb": (torch.cuda.get_device_properties(0).total_memory - torch.cuda.memory_allocated(0)) / 1024**3
+            "total_gb": _GPU_TOTAL / 1024**3,
+            "free_gb": (_GPU_TOTAL - torch.cuda.memory_allocated(0)) / 1024**3
         }
     }
 
@@ -1,10 +1,38 @@
 """
 Model Loader for LLM Inference - Phase 2: Kubernetes
-Same code as Phase 1
+Same code as Phase 1, plus a continuous batching engine for concurrent requests
 """
 
+import asyncio
+import os
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Iterator, List, Optional, Tuple
+
+# The CUDA caching allocator reads this once, on first CUDA use, so it must be
+# set before anything touches the GPU. Expandable segments grow existing
+# blocks instead of carving new ones, which keeps reserved memory close to
+# allocated memory as batch sizes change.
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True")
+
 import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer, LlamaTokenizerFast
+import torch.nn.functional as F
+from accelerate import init_empty_weights
+from safetensors import safe_open
+from transformers import (
+    AutoConfig,
+    AutoModelForCausalLM,
+    AutoTokenizer,
+    BitsAndBytesConfig,
+    DynamicCache,
+    GenerationConfig,
+    LlamaTokenizerFast,
+    StoppingCriteria,
+    StoppingCriteriaList,
+    TextIteratorStreamer,
+)
 import logging
 import json
 from pathlib import Path
@@ -15,19 +43,44 @@ logger = logging.getLogger(__name__)
 class ModelLoader:
     """Load and manage LLM on GPU"""
     
-    def __init__(self, model_path: str = "/app/model", device: str = "auto"):
+    def __init__(
+        self,
+        model_path: str = "/app/model",
+        device: str = "auto",
+        kv_quant: bool = False,
+        quantization: str = "none",
+        compile_model: bool = False,
+        draft_model_path: Optional[str] = None
+    ):
         """
         Initialize model loader
         
         Args:
             model_path: Path to model directory
             device: Device to load model on ('auto', 'cuda', 'cpu')
+            kv_quant: Store the KV cache as INT8 (halves cache memory, so a
+                larger batch fits, at some accuracy and quantize/dequantize cost)
+            quantization: Weight quantization ('none' or 'int8_weight_only').
+                Weights are stored in 8 bits, activations stay FP16. Uses FP8
+                on Hopper (sm_90+) GPUs and bitsandbytes INT8 elsewhere, which
+                saves memory but decodes slower than FP16 and skips the direct
+                safetensors load and torch.compile.
+            compile_model: Compile the forward pass with torch.compile
+                (fused kernels, no CUDA graphs). Slower startup, fewer kernel
+                launches per decode step.
+            draft_model_path: Optional small model sharing the tokenizer (e.g.
+                Llama 3.2 1B) used for speculative decoding in generate() and
+                generate_stream()
         """
         self.model_path = model_path
         self.device = self._get_device(device)
+        self.kv_quant = kv_quant
+        self.quantization = self._get_quantization(quantization)
         
         logger.info(f"Loading model from {model_path}")
         logger.info(f"Target device: {self.device}")
+        logger.info(f"KV cache: {'INT8' if kv_quant else 'FP16'}")
+        logger.info(f"Weight quantization: {self.quantization}")
         
         # Load tokenizer - use specific tokenizer class to avoid AutoTokenizer bug
         try:            
@@ -59,14 +112,33 @@ class ModelLoader:
         # Load model with optimizations
         logger.info("Loading model to GPU...")
         if self.device == "cuda":
+            # INT8 weights are quantized by bitsandbytes while loading
+            quantization_config = None
+            if self.quantization == "int8":
+                quantization_config = BitsAndBytesConfig(load_in_8bit=True)
+            
+            # Unquantized/FP8 weights are read straight into VRAM; bitsandbytes
+            # has to quantize while loading, so INT8 goes through from_pretrained
+            self.model = None
+            if quantization_config is None:
+                self.model = self._load_safetensors_to_gpu()
+            
             # Force model to GPU (don't let accelerate offload to CPU)
-            self.model = AutoModelForCausalLM.from_pretrained(
-                model_path,
-                torch_dtype=torch.float16,
-                device_map="cuda:0",  # Force all layers to GPU 0
-                trust_remote_code=True,
-                low_cpu_mem_usage=True,
-            )
+            if self.model is None:
+                self.model = AutoModelForCausalLM.from_pretrained(
+                    model_path,
+                    torch_dtype=torch.float16,
+                    device_map="cuda:0",  # Force all layers to GPU 0
+                    trust_remote_code=True,
+                    low_cpu_mem_usage=True,
+                    quantization_config=quantization_config,
+                    attn_implementation=self._get_attn_implementation(),
+                )
+            
+            # FP8 weights are quantized in place by torchao after loading
+            if self.quantization == "fp8":
+                from torchao.quantization import Float8WeightOnlyConfig, quantize_
+                quantize_(self.model, Float8WeightOnlyConfig())
         else:
             # CPU mode
             self.model = AutoModelForCausalLM.from_pretrained(
@@ -80,22 +152,159 @@ class ModelLoader:
         # Set to evaluation mode
         self.model.eval()
         
+        # Fuse elementwise ops to cut per-op launch overhead
+        if compile_model:
+            self._compile()
+        
+        # Draft model proposes tokens that the main model verifies in one forward
+        self.draft_model = None
+        if draft_model_path:
+            logger.info(f"Loading draft model from {draft_model_path}")
+            self.draft_model = AutoModelForCausalLM.from_pretrained(
+                draft_model_path,
+                torch_dtype=torch.float16 if self.device == "cuda" else torch.float32,
+                trust_remote_code=True,
+                low_cpu_mem_usage=True,
+            ).to(self.device).eval()
+        
         # Log model info
         self._log_model_info()
         
         logger.info("Model loaded successfully!")
     
+    def _load_safetensors_to_gpu(self) -> Optional[torch.nn.Module]:
+        """
+        Build the model on the meta device and read each safetensors shard
+        directly into GPU memory, skipping the CPU copy from_pretrained stages
+        every tensor through. Returns None if the checkpoint can't be loaded
+        this way, so the caller falls back to from_pretrained.
+        """
+        shards = sorted(Path(self.model_path).glob("*.safetensors"))
+        if not shards:
+            return None
+        
+        try:
+            config = AutoConfig.from_pretrained(self.model_path, trust_remote_code=True)
+            # Buffers (e.g. rotary frequencies) aren't in the checkpoint, so
+            # only parameters are left on the meta device
+            with init_empty_weights(include_buffers=False):
+                model = AutoModelForCausalLM.from_config(
+                    config,
+                    torch_dtype=torch.float16,
+                    trust_remote_code=True,
+                    attn_implementation=self._get_attn_implementation(),
+                )
+            
+            for shard in shards:
+                with safe_open(str(shard), framework="pt", device="cuda:0") as f:
+                    state = {}
+                    for name in f.keys():
+                        tensor = f.get_tensor(name)
+                        state[name] = tensor.half() if tensor.is_floating_point() else tensor
+                model.load_state_dict(state, strict=False, assign=True)
+                del state
+            
+            # Tied output embeddings aren't stored separately in the checkpoint
+            model.tie_weights()
+            missing = [name for name, p in model.named_parameters() if p.is_meta]
+            if missing:
+                raise RuntimeError(f"{len(missing)} parameters missing from checkpoint, e.g. {missing[0]}")
+            
+            model.to("cuda:0")
+            try:
+                model.generation_config = GenerationConfig.from_pretrained(self.model_path)
+            except OSError:
+                pass
+        except Exception as e:
+            logger.warning(f"Direct safetensors load failed, falling back to from_pretrained: {e}")
+            torch.cuda.empty_cache()
+            return None
+        
+        logger.info(f"Loaded {len(shards)} safetensors shard(s) directly to GPU")
+        return model
+    
     def _get_device(self, device: str) -> str:
         """Determine device to use"""
         if device == "auto":
             return "cuda" if torch.cuda.is_available() else "cpu"
         return device
     
+    def _get_quantization(self, quantization: str) -> str:
+        """Pick the weight format ('fp8', 'int8' or 'none') for this GPU"""
+        if quantization == "none":
+            return "none"
+        if quantization != "int8_weight_only":
+            raise ValueError(f"Unknown quantization: {quantization}")
+        if self.device != "cuda":
+            logger.warning("Weight quantization requires a GPU, loading full precision weights")
+            return "none"
+        
+        # Hopper and newer have native FP8 support
+        if torch.cuda.get_device_capability(0) >= (9, 0):
+            try:
+                import torchao  # noqa: F401
+                return "fp8"
+            except ImportError:
+                logger.warning("torchao not installed, falling back to INT8 weights")
+        
+        try:
+            import bitsandbytes  # noqa: F401
+            return "int8"
+        except ImportError:
+            logger.warning("bitsandbytes not installed, loading FP16 weights")
+            logger.warning("Install with: pip install bitsandbytes")
+            return "none"
+    
+    def _get_attn_implementation(self) -> str:
+        """Use fused FlashAttention-2 kernels when available, else PyTorch SDPA"""
+        # FlashAttention-2 needs Ampere (sm_80) or newer
+        if torch.cuda.get_device_capability(0) < (8, 0):
+            return "sdpa"
+        try:
+            import flash_attn  # noqa: F401
+        except ImportError:
+            logger.warning("flash-attn not installed, using PyTorch SDPA attention")
+            return "sdpa"
+        logger.info("Using FlashAttention-2")
+        return "flash_attention_2"
+    
+    def _compile(self):
+        """Compile the forward pass and warm it up for prefill and decode"""
+        if self.device != "cuda":
+            logger.warning("torch.compile requires a GPU, skipping compilation")
+            return
+        if self.quantization == "int8":
+            logger.warning("bitsandbytes INT8 layers do not support torch.compile, skipping compilation")
+            return
+        
+        # No CUDA graphs: the KV length changes every step and the batch size on
+        # every admit/evict, so each would record a new graph. Kernel fusion
+        # still applies across the dynamic shapes.
+        logger.info("Compiling model (mode=max-autotune-no-cudagraphs)...")
+        self.model.forward = torch.compile(self.model.forward, mode="max-autotune-no-cudagraphs", dynamic=True)
+        
+        # Trigger compilation for prefill + one decode step; sizes of 1 are
+        # specialized, so warm up a single prompt and a batch of two
+        start_time = time.time()
+        with torch.no_grad():
+            for batch_size in (1, 2):
+                input_ids = torch.full((batch_size, 128), self.tokenizer.pad_token_id, dtype=torch.long, device=self.device)
+                cache = Int8KVCache() if self.kv_quant else BatchKVCache()
+                outputs = self.model(input_ids=input_ids, past_key_values=cache, use_cache=True)
+                self.model(
+                    input_ids=outputs.logits[:, -1:].argmax(dim=-1),
+                    past_key_values=outputs.past_key_values,
+                    use_cache=True,
+                )
+        torch.cuda.synchronize()
+        logger.info(f"Model compiled in {time.time() - start_time:.1f}s")
+    
     def _log_model_info(self):
         """Log model and GPU information"""
         # Count parameters
         total_params = sum(p.numel() for p in self.model.parameters())
         logger.info(f"Model parameters: {total_params / 1e9:.2f}B")
+        logger.info(f"Model weights: {self.model.get_memory_footprint() / 1024**3:.2f} GB ({self.quantization})")
         
         # GPU memory if available
         if torch.cuda.is_available():
@@ -104,6 +313,30 @@ class ModelLoader:
             logger.info(f"GPU memory allocated: {allocated:.2f} GB")
             logger.info(f"GPU memory reserved: {reserved:.2f} GB")
     
+    def _prepare_inputs(self, prompt: str) -> dict:
+        """Tokenize a prompt into model.generate() inputs on the target device"""
+        # Tokenize input
+        inputs = self.tokenizer(
+            prompt,
+            return_tensors="pt",
+            padding=True,
+            truncation=True,
+            max_length=2048
+        )
+        
+        # Move to device
+        inputs = _to_device(inputs, self.device)
+        
+        # Use the INT8 cache instead of the default FP16 one
+        if self.kv_quant:
+            inputs["past_key_values"] = Int8KVCache()
+        
+        # Speculative decoding (greedy verification, or rejection sampling when sampling)
+        if self.draft_model is not None:
+            inputs["assistant_model"] = self.draft_model
+        
+        return inputs
+    
     def generate(
         self,
         prompt: str,
@@ -112,7 +345,7 @@ class ModelLoader:
         top_p: float = 0.9,
         top_k: int = 50,
         do_sample: bool = True
-    ) -> str:
+    ) -> Tuple[str, int]:
         """
         Generate text from prompt
         
@@ -125,19 +358,9 @@ class ModelLoader:
             do_sample: Whether to use sampling (vs greedy decoding)
         
         Returns:
-            Generated text (without prompt)
+            Generated text (without prompt) and number of generated tokens
         """
-        # Tokenize input
-        inputs = self.tokenizer(
-            prompt,
-            return_tensors="pt",
-            padding=True,
-            truncation=True,
-            max_length=2048
-        )
-        
-        # Move to device
-        inputs = {k: v.to(self.device) for k, v in inputs.items()}
+        inputs = self._prepare_inputs(prompt)
         
         # Generate
         with torch.no_grad():
@@ -153,17 +376,79 @@ class ModelLoader:
                 use_cache=True,  # Enable KV cache for faster generation
             )
         
-        # Decode output
+        n_new_tokens = outputs.shape[1] - inputs["input_ids"].shape[1]
+        
+        # Decode only the new tokens, not the echoed prompt
         generated_text = self.tokenizer.decode(
-            outputs[0],
+            outputs[0, inputs["input_ids"].shape[1]:],
             skip_special_tokens=True
-        )
+        ).strip()
         
-        # Remove prompt from output
-        if generated_text.startswith(prompt):
-            generated_text = generated_text[len(prompt):].strip()
+        return generated_text, n_new_tokens
+    
+    def generate_stream(
+        self,
+        prompt: str,
+        max_tokens: int = 200,
+        temperature: float = 0.7,
+        top_p: float = 0.9,
+        top_k: int = 50,
+        do_sample: bool = True
+    ) -> Iterator[str]:
+        """
+        Generate text from prompt, yielding decoded text as it is produced
         
-        return generated_text
+        Args:
+            prompt: Input text prompt
+            max_tokens: Maximum tokens to generate
+            temperature: Sampling temperature (higher = more random)
+            top_p: Nucleus sampling threshold
+            top_k: Top-k sampling parameter
+            do_sample: Whether to use sampling (vs greedy decoding)
+        
+        Yields:
+            Pieces of generated text (without prompt)
+        """
+        inputs = self._prepare_inputs(prompt)
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        stop = threading.Event()
+        errors = []
+        
+        def run():
+            try:
+                with torch.no_grad():
+                    self.model.generate(
+                        **inputs,
+                        max_new_tokens=max_tokens,
+                        temperature=temperature,
+                        top_p=top_p,
+                        top_k=top_k,
+                        do_sample=do_sample,
+                        pad_token_id=self.tokenizer.pad_token_id,
+                        eos_token_id=self.tokenizer.eos_token_id,
+                        use_cache=True,
+                        streamer=streamer,
+                        stopping_criteria=StoppingCriteriaList([_StopOnEvent(stop)]),
+                    )
+            except Exception as e:
+                errors.append(e)
+                streamer.end()  # Unblock the consumer
+        
+        # generate() blocks, so it runs in its own thread while we drain the streamer
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        try:
+            for text in streamer:
+                if text:
+                    yield text
+        finally:
+            # Stops decoding if the consumer closed us early (client disconnected)
+            stop.set()
+            thread.join()
+        
+        # Surface generation errors to the caller instead of ending silently
+        if errors:
+            raise errors[0]
     
     def __del__(self):
         """Cleanup GPU memory on deletion"""
@@ -173,3 +458,456 @@ class ModelLoader:
             del self.tokenizer
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
+
+
+class _StopOnEvent(StoppingCriteria):
+    """Stop generate() as soon as `event` is set"""
+
+    def __init__(self, event: threading.Event):
+        self.event = event
+
+    def __call__(self, input_ids: torch.Tensor, scores: torch.Tensor, **kwargs) -> torch.Tensor:
+        return torch.full((input_ids.shape[0],), self.event.is_set(), dtype=torch.bool, device=input_ids.device)
+
+
+@dataclass
+class SamplingParams:
+    """Per-request sampling settings"""
+    max_tokens: int = 200
+    temperature: float = 0.7
+    top_p: float = 0.9
+    top_k: int = 50
+    do_sample: bool = True
+
+
+@dataclass
+class _Sequence:
+    """A request tracked by the engine while it is queued or decoding"""
+    prompt: str
+    params: SamplingParams
+    future: asyncio.Future
+    loop: asyncio.AbstractEventLoop
+    output_ids: List[int] = field(default_factory=list)
+
+
+class BatchKVCache(DynamicCache):
+    """DynamicCache that can be split and merged along the batch dimension"""
+
+    def to_tensors(self) -> List[Tuple[torch.Tensor, ...]]:
+        """Per-layer cache tensors, each shaped [batch, heads, seq, ...]"""
+        return [tuple(layer) for layer in self.to_legacy_cache()]
+
+    @classmethod
+    def from_tensors(cls, layers: List[Tuple[torch.Tensor, ...]]) -> "BatchKVCache":
+        """Rebuild a cache from the output of `to_tensors`"""
+        return cls.from_legacy_cache(tuple(layers))
+
+
+def _quantize_int8(x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Symmetric INT8 quantization with one scale per (token, head), kept in x's dtype"""
+    scale = x.abs().amax(dim=-1, keepdim=True).float().clamp(min=1e-8) / 127
+    return (x.float() / scale).round().clamp(-127, 127).to(torch.int8), scale.to(x.dtype)
+
+
+def _dequantize_int8(q: torch.Tensor, scale: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
+    """Inverse of `_quantize_int8`, computed directly in `dtype` (no FP32 copy)"""
+    return q.to(dtype) * scale.to(dtype)
+
+
+class Int8KVCache(BatchKVCache):
+    """
+    KV cache stored as INT8 plus per-(token, head) scales
+
+    Keys/values are quantized as they are appended and dequantized one layer
+    at a time when attention reads them, so only a single layer is ever held
+    in FP16. Halves resident cache memory, i.e. roughly twice the batch size
+    fits in the same VRAM.
+    """
+
+    # Buffers grow in blocks of this many tokens instead of one torch.cat per step
+    BLOCK_SIZE = 256
+
+    def __init__(self):
+        super().__init__()
+        # Per layer: [key_int8, key_scale, value_int8, value_scale] buffers,
+        # of which only the first `_lengths[layer]` positions are filled
+        self._layers: List[List[torch.Tensor]] = []
+        self._lengths: List[int] = []
+        self._dtype = torch.float16
+
+    # The per-layer lengths are Python ints that change every step; tracing
+    # them would make dynamo guard on them and recompile each decode step
+    @torch.compiler.disable
+    def update(self, key_states, value_states, layer_idx, cache_kwargs=None):
+        """Append new keys/values for a layer and return the full (dequantized) history"""
+        if layer_idx == 0:
+            self._seen_tokens += key_states.shape[-2]
+        self._dtype = key_states.dtype
+
+        new = [*_quantize_int8(key_states), *_quantize_int8(value_states)]
+        added = key_states.shape[-2]
+        if len(self._layers) <= layer_idx:
+            self._layers.append([_resize_seq(t, added, added + self.BLOCK_SIZE) for t in new])
+            self._lengths.append(added)
+        else:
+            length = self._lengths[layer_idx]
+            buffers = self._layers[layer_idx]
+            if length + added > buffers[0].shape[-2]:
+                capacity = length + added + self.BLOCK_SIZE
+                buffers = self._layers[layer_idx] = [_resize_seq(t, length, capacity) for t in buffers]
+            # Write the new positions in place
+            for buffer, appended in zip(buffers, new):
+                buffer[:, :, length:length + added] = appended
+            self._lengths[layer_idx] = length + added
+
+        length = self._lengths[layer_idx]
+        key_q, key_scale, value_q, value_scale = (t[:, :, :length] for t in self._layers[layer_idx])
+        return (
+            _dequantize_int8(key_q, key_scale, self._dtype),
+            _dequantize_int8(value_q, value_scale, self._dtype),
+        )
+
+    def __len__(self) -> int:
+        """Number of cached layers (generate() checks the cache's truthiness)"""
+        return len(self._layers)
+
+    def get_seq_length(self, layer_idx: Optional[int] = 0) -> int:
+        """Number of cached tokens"""
+        if len(self._lengths) <= layer_idx:
+            return 0
+        return self._lengths[layer_idx]
+
+    def crop(self, max_length: int):
+        """Drop cached tokens past max_length (used to discard rejected draft tokens)"""
+        if max_length < 0:
+            max_length = self.get_seq_length() - abs(max_length)
+        self._lengths = [min(length, max_length) for length in self._lengths]
+        self._seen_tokens = self.get_seq_length()
+
+    def to_tensors(self) -> List[Tuple[torch.Tensor, ...]]:
+        """Per-layer quantized tensors and scales, each shaped [batch, heads, seq, ...]"""
+        return [
+            tuple(t[:, :, :length] for t in layer)
+            for layer, length in zip(self._layers, self._lengths)
+        ]
+
+    @classmethod
+    def from_tensors(cls, layers: List[Tuple[torch.Tensor, ...]]) -> "Int8KVCache":
+        """Rebuild a cache from the output of `to_tensors`"""
+        cache = cls()
+        cache._layers = [list(layer) for layer in layers]
+        cache._lengths = [layer[0].shape[-2] for layer in layers]
+        cache._seen_tokens = cache.get_seq_length()
+        return cache
+
+
+def _resize_seq(tensor: torch.Tensor, length: int, capacity: int) -> torch.Tensor:
+    """Copy the first `length` positions of dim -2 into a buffer holding `capacity`"""
+    shape = list(tensor.shape)
+    shape[-2] = capacity
+    buffer = tensor.new_zeros(shape)
+    buffer[:, :, :length] = tensor[:, :, :length]
+    return buffer
+
+
+def _to_device(tensors: dict, device: str) -> dict:
+    """Copy tokenizer output to the device without blocking the calling thread"""
+    if device == "cuda":
+        # Only copies from pinned (page-locked) host memory are truly asynchronous;
+        # PyTorch's host allocator caches pinned blocks so this does not re-pin each call
+        return {k: v.pin_memory().to(device, non_blocking=True) for k, v in tensors.items()}
+    return {k: v.to(device) for k, v in tensors.items()}
+
+
+def _left_pad(tensor: torch.Tensor, width: int, dim: int) -> torch.Tensor:
+    """Zero-pad `tensor` on the left of `dim`"""
+    if width == 0:
+        return tensor
+    shape = list(tensor.shape)
+    shape[dim] = width
+    return torch.cat([tensor.new_zeros(shape), tensor], dim=dim)
+
+
+def _set_future(future: asyncio.Future, result=None, error: Optional[Exception] = None):
+    """Resolve a future on its own event loop (no-op if the client went away)"""
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+class BatchedEngine:
+    """
+    Continuous (iteration-level) batching on top of a loaded model
+
+    A worker thread owns the model and runs one forward pass per decode step
+    for every in-flight request. New requests are admitted between steps and
+    finished ones are evicted, so the batch never waits for its slowest row.
+    """
+
+    def __init__(self, loader: ModelLoader, max_batch_size: int = 16, batch_window: float = 0.005):
+        """
+        Initialize engine and start the worker thread
+
+        Args:
+            loader: Loaded model and tokenizer
+            max_batch_size: Maximum number of sequences decoded together
+            batch_window: Seconds an idle engine waits after the first request
+                for more to arrive, so a burst shares one prefill
+        """
+        self.model = loader.model
+        self.tokenizer = loader.tokenizer
+        self.device = loader.device
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+        self._cache_cls = Int8KVCache if loader.kv_quant else BatchKVCache
+
+        # Prompts are batch-tokenized with left padding (single prompts never pad)
+        self.tokenizer.padding_side = "left"
+
+        # Llama 3 instruct models stop on several ids (<|eot_id|>, <|end_of_text|>)
+        eos = self.model.generation_config.eos_token_id
+        eos = eos if isinstance(eos, (list, tuple)) else [eos]
+        self._eos_ids = {i for i in [*eos, self.tokenizer.eos_token_id] if i is not None}
+
+        # Requests cross from the event loop to the worker thread here
+        self._queue: "queue.Queue[_Sequence]" = queue.Queue()
+
+        # Batch state, one row per running sequence
+        self._running: List[_Sequence] = []
+        self._cache: Optional[BatchKVCache] = None
+        self._attention_mask: Optional[torch.Tensor] = None  # [batch, cached_len]
+        self._next_tokens: Optional[torch.Tensor] = None     # [batch, 1], sampled but not yet fed
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="batched-engine", daemon=True)
+        self._thread.start()
+        logger.info(f"Batched engine started (max batch size: {max_batch_size})")
+
+    async def submit(
+        self,
+        prompt: str,
+        max_tokens: int = 200,
+        temperature: float = 0.7,
+        top_p: float = 0.9,
+        top_k: int = 50,
+        do_sample: bool = True
+    ) -> Tuple[str, int]:
+        """
+        Queue a prompt and wait for its completion
+
+        Args:
+            prompt: Input text prompt
+            max_tokens: Maximum tokens to generate
+            temperature: Sampling temperature (higher = more random)
+            top_p: Nucleus sampling threshold
+            top_k: Top-k sampling parameter
+            do_sample: Whether to use sampling (vs greedy decoding)
+
+        Returns:
+            Generated text (without prompt) and number of generated tokens
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        params = SamplingParams(max_tokens, temperature, top_p, top_k, do_sample)
+        self._queue.put(_Sequence(prompt, params, future, loop))
+        return await future
+
+    def close(self):
+        """Stop the worker thread and fail anything still in flight"""
+        self._stop.set()
+        self._thread.join(timeout=5)
+        self._fail(self._running + self._drain(self._queue.qsize()), RuntimeError("Engine stopped"))
+        self._reset()
+
+    def _run(self):
+        """Worker loop: run one decode step and admit new requests"""
+        while not self._stop.is_set():
+            pending = []
+            if not self._running:
+                # Nothing to decode, block until a request arrives
+                try:
+                    pending.append(self._queue.get(timeout=0.1))
+                except queue.Empty:
+                    continue
+                pending += self._collect(self.max_batch_size - 1)
+            pending += self._drain(self.max_batch_size - len(self._running) - len(pending))
+
+            try:
+                with torch.no_grad():
+                    # Kernel launches are asynchronous: tokenize new prompts on
+                    # the CPU while the GPU works through the decode step
+                    next_tokens = self._decode_step() if self._running else None
+                    inputs = self._tokenize(pending) if pending else None
+                    if next_tokens is not None:
+                        self._append(self._running, next_tokens)
+                        self._evict_finished()
+                    if inputs is not None:
+                        self._admit(pending, inputs)
+            except Exception as e:
+                logger.error(f"Batched engine step failed: {e}")
+                self._fail(pending + self._running, e)
+                self._reset()
+
+    def _collect(self, limit: int) -> List[_Sequence]:
+        """Wait up to `batch_window` for up to `limit` more requests"""
+        items = []
+        deadline = time.monotonic() + self.batch_window
+        while len(items) < limit:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                items.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return items
+
+    def _drain(self, limit: int) -> List[_Sequence]:
+        """Take up to `limit` queued requests without blocking"""
+        items = []
+        while len(items) < limit:
+            try:
+                items.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return items
+
+    def _tokenize(self, pending: List[_Sequence]) -> dict:
+        """Tokenize new prompts in one call and start copying them to the GPU"""
+        # Left-pad so every prompt ends at the same position
+        batch = self.tokenizer(
+            [seq.prompt for seq in pending],
+            return_tensors="pt",
+            padding="longest",
+            truncation=True,
+            max_length=2048
+        )
+        return _to_device({k: batch[k] for k in ("input_ids", "attention_mask")}, self.device)
+
+    def _admit(self, pending: List[_Sequence], inputs: dict):
+        """Prefill new prompts and merge them into the running batch"""
+        input_ids = inputs["input_ids"]
+        attention_mask = inputs["attention_mask"]
+        width = input_ids.shape[1]
+
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=(attention_mask.cumsum(-1) - 1).clamp(min=0),
+            past_key_values=self._cache_cls(),
+            use_cache=True,
+            num_logits_to_keep=1,  # Only the last position is sampled; skip [batch, seq, vocab] logits
+        )
+        next_tokens = self._sample(outputs.logits[:, -1, :], pending)
+
+        if self._running:
+            # Align both caches on the right edge, then stack the rows
+            cached_len = self._attention_mask.shape[1]
+            total_len = max(cached_len, width)
+            layers = [
+                tuple(
+                    torch.cat([_left_pad(old, total_len - cached_len, -2),
+                               _left_pad(new, total_len - width, -2)])
+                    for old, new in zip(old_layer, new_layer)
+                )
+                for old_layer, new_layer in zip(self._cache.to_tensors(), outputs.past_key_values.to_tensors())
+            ]
+            self._cache = self._cache_cls.from_tensors(layers)
+            self._attention_mask = torch.cat([
+                _left_pad(self._attention_mask, total_len - cached_len, 1),
+                _left_pad(attention_mask, total_len - width, 1),
+            ])
+            self._next_tokens = torch.cat([self._next_tokens, next_tokens.unsqueeze(1)])
+        else:
+            self._cache = outputs.past_key_values
+            self._attention_mask = attention_mask
+            self._next_tokens = next_tokens.unsqueeze(1)
+        self._running += pending
+
+        self._append(pending, next_tokens)
+        self._evict_finished()
+
+    def _decode_step(self) -> torch.Tensor:
+        """Feed the last sampled token of every row through the model once"""
+        attention_mask = F.pad(self._attention_mask, (0, 1), value=1)
+        outputs = self.model(
+            input_ids=self._next_tokens,
+            attention_mask=attention_mask,
+            position_ids=attention_mask.sum(-1, keepdim=True) - 1,
+            past_key_values=self._cache,
+            use_cache=True,
+        )
+        self._cache = outputs.past_key_values
+        self._attention_mask = attention_mask
+
+        next_tokens = self._sample(outputs.logits[:, -1, :], self._running)
+        self._next_tokens = next_tokens.unsqueeze(1)
+        return next_tokens
+
+    def _sample(self, logits: torch.Tensor, seqs: List[_Sequence]) -> torch.Tensor:
+        """Pick the next token for each row, honouring per-row sampling params"""
+        logits = logits.float()
+        vocab_size = logits.shape[-1]
+        temperature = torch.tensor([seq.params.temperature for seq in seqs], device=logits.device)
+        top_k = torch.tensor([seq.params.top_k or vocab_size for seq in seqs], device=logits.device)
+        top_p = torch.tensor([seq.params.top_p for seq in seqs], device=logits.device)
+        do_sample = torch.tensor([seq.params.do_sample for seq in seqs], device=logits.device)
+
+        # Top-k and top-p for the whole batch in one sorted pass
+        sorted_logits, sorted_ids = (logits / temperature.unsqueeze(1)).sort(dim=-1, descending=True)
+        ranks = torch.arange(vocab_size, device=logits.device).unsqueeze(0)
+        sorted_logits = sorted_logits.masked_fill(ranks >= top_k.unsqueeze(1), float("-inf"))
+        probs = sorted_logits.softmax(dim=-1)
+        # Drop a token once the mass ranked above it already exceeds top_p
+        sorted_logits = sorted_logits.masked_fill(probs.cumsum(dim=-1) - probs > top_p.unsqueeze(1), float("-inf"))
+        choice = torch.multinomial(sorted_logits.softmax(dim=-1), num_samples=1)
+        sampled = sorted_ids.gather(-1, choice).squeeze(1)
+
+        return torch.where(do_sample, sampled, logits.argmax(dim=-1))
+
+    def _append(self, seqs: List[_Sequence], next_tokens: torch.Tensor):
+        """Record one sampled token per sequence"""
+        for seq, token in zip(seqs, next_tokens.tolist()):
+            seq.output_ids.append(token)
+
+    def _evict_finished(self):
+        """Resolve finished requests and drop their rows from the batch"""
+        keep = []
+        for row, seq in enumerate(self._running):
+            if seq.output_ids[-1] in self._eos_ids or len(seq.output_ids) >= seq.params.max_tokens:
+                text = self.tokenizer.decode(seq.output_ids, skip_special_tokens=True).strip()
+                seq.loop.call_soon_threadsafe(_set_future, seq.future, (text, len(seq.output_ids)))
+            elif not seq.future.cancelled():
+                keep.append(row)
+
+        if len(keep) == len(self._running):
+            return
+        if not keep:
+            self._reset()
+            return
+
+        # Keep surviving rows and drop cache columns that are now padding for everyone
+        rows = torch.tensor(keep, device=self._attention_mask.device)
+        attention_mask = self._attention_mask[rows]
+        start = int(attention_mask.any(dim=0).int().argmax())
+        self._cache = self._cache_cls.from_tensors([
+            tuple(t[rows, :, start:] for t in layer) for layer in self._cache.to_tensors()
+        ])
+        self._attention_mask = attention_mask[:, start:]
+        self._next_tokens = self._next_tokens[rows]
+        self._running = [self._running[row] for row in keep]
+
+    def _fail(self, seqs: List[_Sequence], error: Exception):
+        """Propagate an error to every waiting client"""
+        for seq in seqs:
+            seq.loop.call_soon_threadsafe(_set_future, seq.future, None, error)
+
+    def _reset(self):
+        """Drop all batch state"""
+        self._running = []
+        self._cache = None
+        self._attention_mask = None
+        self._next_tokens = None
@@ -4,70 +4,115 @@ Phase 3 - GPU Fraction Test Application
 Demonstrates GPU sharing with Run:AI
 """
 
-from flask import Flask, jsonify, request
-import subprocess
+from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel
+from typing import Optional
+import asyncio
+import pynvml
 import os
 import socket
 import time
 from datetime import datetime
 
-app = Flask(__name__)
+app = FastAPI(title="Phase 3 - Run:AI GPU Sharing Demo", default_response_class=ORJSONResponse)
 
-# Track requests
+# Track requests (per worker process). Handlers run on a single event loop
+# thread and never await between read and increment, so no lock is needed.
 request_count = 0
 start_time = time.time()
 
+GPU_INFO_TTL = 0.25  # seconds, NVML results are reused for this long
+
+
+class _GpuProbe:
+    """Query GPU 0 in-process through NVML, caching results for a short TTL"""
+
+    def __init__(self, index=0, ttl=GPU_INFO_TTL):
+        self.ttl = ttl
+        self._cache = {}
+        try:
+            pynvml.nvmlInit()
+            self.handle = pynvml.nvmlDeviceGetHandleByIndex(index)
+            # The name never changes, so it is looked up once here
+            name = pynvml.nvmlDeviceGetName(self.handle)
+            self.name = name.decode() if isinstance(name, bytes) else name
+            self.error = None
+        except pynvml.NVMLError as e:
+            self.handle = None
+            self.name = None
+            self.error = str(e)
+
+    def _cached(self, key, query):
+        """Return the cached value for key, re-running query once it is older than the TTL"""
+        now = time.monotonic()
+        entry = self._cache.get(key)
+        if entry is None or now - entry[0] > self.ttl:
+            entry = (now, query())
+            self._cache[key] = entry
+        return entry[1]
+
+    def gpu_info(self):
+        """Name, memory and utilization (same format as nvidia-smi CSV output)"""
+        return self._cached('gpu_info', self._query_gpu_info)
+
+    def cuda_processes(self):
+        """Number of compute processes on the GPU"""
+        return self._cached('cuda_processes', self._query_cuda_processes)
+
+    def _query_gpu_info(self):
+        if self.handle is None:
+            return {'error': self.error or 'GPU not available'}
+        try:
+            memory = pynvml.nvmlDeviceGetMemoryInfo(self.handle)
+            utilization = pynvml.nvmlDeviceGetUtilizationRates(self.handle)
+        except pynvml.NVMLError as e:
+            return {'error': str(e)}
+        return {
+            'gpu_name': self.name,
+            'memory_total': f'{memory.total // 1024**2} MiB',
+            'memory_used': f'{memory.used // 1024**2} MiB',
+            'utilization': f'{utilization.gpu} %'
+        }
+
+    def _query_cuda_processes(self):
+        if self.handle is None:
+            return 0
+        try:
+            return len(pynvml.nvmlDeviceGetComputeRunningProcesses(self.handle))
+        except pynvml.NVMLError:
+            return 0
+
+
+gpu_probe = _GpuProbe()
+
 def get_gpu_info():
-    """Get GPU information using nvidia-smi"""
-    try:
-        result = subprocess.run(
-            ['nvidia-smi', '--query-gpu=name,memory.total,memory.used,utilization.gpu', '--format=csv,noheader'],
-            capture_output=True,
-            text=True,
-            timeout=5
-        )
-        if result.returncode == 0:
-            gpu_data = result.stdout.strip().split(', ')
-            return {
-                'gpu_name': gpu_data[0],
-                'memory_total': gpu_data[1],
-                'memory_used': gpu_data[2],
-                'utilization': gpu_data[3]
-            }
-    except Exception as e:
-        return {'error': str(e)}
-    return {'error': 'GPU not available'}
+    """Get GPU information using NVML"""
+    return gpu_probe.gpu_info()
 
 def get_cuda_processes():
     """Get number of CUDA processes sharing this GPU"""
-    try:
-        result = subprocess.run(
-            ['nvidia-smi', '--query-compute-apps=pid', '--format=csv,noheader'],
-            capture_output=True,
-            text=True,
-            timeout=5
-        )
-        if result.returncode == 0:
-            processes = [p for p in result.stdout.strip().split('\n') if p]
-            return len(processes)
-    except:
-        pass
-    return 0
-
-@app.route('/health')
-def health():
+    return gpu_probe.cuda_processes()
+
+class GenerateRequest(BaseModel):
+    """Request schema for simulated inference"""
+    prompt: str = 'Default prompt'
+    max_tokens: int = 100
+
+@app.get('/health')
+async def health():
     """Health check endpoint"""
-    return jsonify({'status': 'healthy', 'timestamp': datetime.now().isoformat()})
+    return {'status': 'healthy', 'timestamp': datetime.now().isoformat()}
 
-@app.route('/generate', methods=['POST'])
-def generate():
+@app.post('/generate')
+async def generate(body: Optional[GenerateRequest] = None):
     """Simulate inference request"""
     global request_count
     request_count += 1
     
-    data = request.get_json() or {}
-    prompt = data.get('prompt', 'Default prompt')
-    max_tokens = data.get('max_tokens', 100)
+    data = body or GenerateRequest()
+    prompt = data.prompt
+    max_tokens = data.max_tokens
     
     # Get GPU info
     gpu_info = get_gpu_info()
@@ -75,7 +120,7 @@ def generate():
     
     # Simulate some GPU work (just a tiny CUDA operation)
     # In reality, this would be your LLM inference
-    time.sleep(0.1)  # Simulate processing time
+    await asyncio.sleep(0.1)  # Simulate processing time (without blocking the event loop)
     
     response = {
         'prompt': prompt,
@@ -89,15 +134,15 @@ def generate():
         'uptime_seconds': int(time.time() - start_time)
     }
     
-    return jsonify(response)
+    return response
 
-@app.route('/stats')
-def stats():
+@app.get('/stats')
+async def stats():
     """Get pod statistics"""
     gpu_info = get_gpu_info()
     cuda_processes = get_cuda_processes()
     
-    return jsonify({
+    return {
         'pod_name': socket.gethostname(),
         'total_requests': request_count,
         'uptime_seconds': int(time.time() - start_time),
@@ -105,12 +150,12 @@ def stats():
         'cuda_processes_sharing_gpu': cuda_processes,
         'runai_gpu_fraction': os.getenv('RUNAI_GPU_FRACTION', '0.33'),
         'cuda_visible_devices': os.getenv('CUDA_VISIBLE_DEVICES', 'all')
-    })
+    }
 
-@app.route('/')
-def root():
+@app.get('/')
+async def root():
     """Root endpoint"""
-    return jsonify({
+    return {
         'service': 'Phase 3 - Run:AI GPU Sharing Demo',
         'pod': socket.gethostname(),
         'endpoints': {
@@ -119,15 +164,15 @@ def root():
             '/stats': 'GET - Pod statistics',
             '/gpu': 'GET - GPU information'
         }
-    })
+    }
 
-@app.route('/gpu')
-def gpu():
+@app.get('/gpu')
+async def gpu():
     """Detailed GPU information"""
     gpu_info = get_gpu_info()
     cuda_processes = get_cuda_processes()
     
-    return jsonify({
+    return {
         'gpu_info': gpu_info,
         'cuda_processes': cuda_processes,
         'environment': {
@@ -135,12 +180,13 @@ def gpu():
             'RUNAI_GPU_FRACTION': os.getenv('RUNAI_GPU_FRACTION', 'not set'),
             'CUDA_MPS_PIPE_DIRECTORY': os.getenv('CUDA_MPS_PIPE_DIRECTORY', 'not set')
         }
-    })
+    }
 
 if __name__ == '__main__':
     print(f"Starting GPU test server on {socket.gethostname()}")
     print(f"GPU Fraction: {os.getenv('RUNAI_GPU_FRACTION', 'unknown')}")
     print(f"CUDA Visible Devices: {os.getenv('CUDA_VISIBLE_DEVICES', 'all')}")
     
-    app.run(host='0.0.0.0', port=8000, debug=False)
+    import uvicorn
+    uvicorn.run('app:app', host='0.0.0.0', port=8000, workers=4)
 
@@ -0,0 +1,74 @@
+"""
+Shared helpers for the tutorial scripts (terminal colors, subprocess calls, JSON)
+"""
+
+import json
+import shutil
+import subprocess
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# orjson parses several times faster; stdlib json is the fallback
+json_loads = orjson.loads if orjson is not None else json.loads
+json_dumps = (lambda obj: orjson.dumps(obj).decode()) if orjson is not None else json.dumps
+
+
+class Colors:
+    """ANSI color codes for terminal output"""
+    GREEN = '\033[92m'
+    RED = '\033[91m'
+    YELLOW = '\033[93m'
+    BLUE = '\033[94m'
+    BOLD = '\033[1m'
+    END = '\033[0m'
+
+
+@lru_cache(maxsize=None)
+def resolve_executable(name: str) -> Optional[str]:
+    """Absolute path of an executable on PATH (looked up once per name)"""
+    return shutil.which(name)
+
+
+def run_command(cmd: List[str], timeout: Optional[float] = 10) -> Tuple[bool, str]:
+    """Run a command and return success status and stdout"""
+    # With an absolute path and close_fds=False, CPython starts the child with
+    # posix_spawn (vfork) instead of fork+exec, so the parent's page tables
+    # aren't copied. Python's own fds are non-inheritable, so none leak.
+    executable = resolve_executable(cmd[0])
+    if executable is None:
+        return False, ""
+    try:
+        result = subprocess.run(
+            [executable, *cmd[1:]],
+            stdin=subprocess.DEVNULL,
+            capture_output=True,
+            text=True,
+            timeout=timeout,
+            close_fds=False
+        )
+        return result.returncode == 0, result.stdout.strip()
+    except subprocess.TimeoutExpired:
+        return False, ""
+
+
+def write_json(path: str, data) -> None:
+    """Write data as indented JSON, with orjson when it is installed"""
+    if orjson is not None:
+        with open(path, 'wb') as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+    else:
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=2)
+
+
+def write_jsonl(path: str, records) -> None:
+    """Write records as newline-delimited JSON, one serialized record at a time"""
+    with open(path, 'wb') as f:
+        for record in records:
+            line = orjson.dumps(record) if orjson is not None else json.dumps(record).encode()
+            f.write(line + b'\n')
@@ -27,11 +27,19 @@ def check_model_directory(model_path: str):
         'tokenizer_config.json': 'Tokenizer configuration',
     }
     
-    # Check for model weight files (various formats)
-    model_files = list(model_dir.glob('*.safetensors')) + \
-                  list(model_dir.glob('*.bin')) + \
-                  list(model_dir.glob('*.pth')) + \
-                  list(model_dir.glob('*.pt'))
+    # Single directory pass: collect all files and pick out model weights
+    # (various formats) along the way, keeping each file's size
+    weight_exts = {'.safetensors', '.bin', '.pth', '.pt'}
+    model_files = []  # (name, size in bytes)
+    all_files = []
+    with os.scandir(model_dir) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            all_files.append(entry.name)
+            if os.path.splitext(entry.name)[1] in weight_exts:
+                model_files.append((entry.name, entry.stat().st_size))
+    model_files.sort()
     
     all_good = True
     
@@ -66,11 +74,10 @@ def check_model_directory(model_path: str):
     # Check model weights
     if model_files:
         print(f"✓ Model weights found: {len(model_files)} file(s)")
-        total_size = sum(f.stat().st_size for f in model_files) / (1024**3)
+        total_size = sum(size for _, size in model_files) / (1024**3)
         print(f"  Total size: {total_size:.2f} GB")
-        for f in model_files[:3]:  # Show first 3
-            size = f.stat().st_size / (1024**3)
-            print(f"  - {f.name} ({size:.2f} GB)")
+        for name, size in model_files[:3]:  # Show first 3
+            print(f"  - {name} ({size / (1024**3):.2f} GB)")
         if len(model_files) > 3:
             print(f"  ... and {len(model_files) - 3} more")
     else:
@@ -80,7 +87,7 @@ def check_model_directory(model_path: str):
     print()
     
     # List all files in directory
-    all_files = sorted([f.name for f in model_dir.iterdir() if f.is_file()])
+    all_files.sort()
     print(f"📋 All files in directory ({len(all_files)}):")
     for filename in all_files[:20]:  # Show first 20
         print(f"  - {filename}")
@@ -16,21 +16,84 @@ Usage:
 """
 
 import argparse
+import json
 import os
+import subprocess
 import sys
 from pathlib import Path
 
 
-def download_model(model_id: str, output_dir: str, token: str = None):
+def verify_model_files(model_dir: Path) -> dict:
+    """
+    Cheap sanity check of a downloaded model without importing transformers
+    
+    Returns the parsed config.json; raises ValueError if something is missing.
+    """
+    with open(model_dir / 'config.json') as f:
+        config = json.load(f)
+    if 'model_type' not in config:
+        raise ValueError("config.json is missing the 'model_type' field")
+    
+    # Must at least be valid JSON
+    with open(model_dir / 'tokenizer_config.json') as f:
+        json.load(f)
+    print(f"✓ Tokenizer config found")
+    
+    weight_exts = {'.safetensors', '.bin', '.pth', '.pt'}
+    total_size = 0
+    weight_files = 0
+    with os.scandir(model_dir) as entries:
+        for entry in entries:
+            if entry.is_file() and os.path.splitext(entry.name)[1] in weight_exts:
+                weight_files += 1
+                total_size += entry.stat().st_size
+    if not weight_files:
+        raise ValueError("No model weight files found (.safetensors, .bin, .pth, .pt)")
+    print(f"✓ Model weights found: {weight_files} file(s), {total_size / (1024**3):.2f} GB")
+    
+    return config
+
+
+def snapshot_download_without_hf_transfer(download_kwargs: dict):
+    """
+    Retry snapshot_download with the default Python downloader
+    
+    huggingface_hub reads HF_HUB_ENABLE_HF_TRANSFER when it is imported, so the
+    retry runs in a fresh interpreter with the variable turned off. Arguments
+    go over stdin to keep the token out of the process list.
+    """
+    code = (
+        "import json, sys\n"
+        "from huggingface_hub import snapshot_download\n"
+        "snapshot_download(**json.load(sys.stdin))\n"
+    )
+    subprocess.run(
+        [sys.executable, "-c", code],
+        input=json.dumps(download_kwargs),
+        text=True,
+        env={**os.environ, "HF_HUB_ENABLE_HF_TRANSFER": "0"},
+        check=True,
+    )
+
+
+def download_model(model_id: str, output_dir: str, token: str = None, verify_strict: bool = False):
     """Download model from HuggingFace Hub"""
     
+    # Use the Rust multi-connection downloader when it is installed. Must be set
+    # before huggingface_hub is imported, which reads it into its constants.
     try:
-        from huggingface_hub import snapshot_download
-        from transformers import AutoTokenizer
+        import hf_transfer  # noqa: F401
+        os.environ.setdefault("HF_HUB_ENABLE_HF_TRANSFER", "1")
+    except ImportError:
+        pass
+    
+    try:
+        from huggingface_hub import constants, snapshot_download
+        from huggingface_hub.utils import HfHubHTTPError
     except ImportError:
         print("Error: Required packages not installed")
         print("\nInstall with:")
-        print("  pip install transformers huggingface-hub accelerate")
+        print("  pip install transformers huggingface-hub accelerate hf_transfer")
         sys.exit(1)
     
     output_path = Path(output_dir)
@@ -59,44 +122,54 @@ def download_model(model_id: str, output_dir: str, token: str = None):
         print(f"  → Model size: ~6-8GB\n")
         
         # Download model with snapshot_download for better progress
-        cache_dir = snapshot_download(
+        download_kwargs = dict(
             repo_id=model_id,
             local_dir=str(output_path),
             local_dir_use_symlinks=False,
             token=token,
             resume_download=True,
+            # Files fetched in parallel by the Python downloader; hf_transfer
+            # ignores this and downloads one file at a time over many connections
+            max_workers=8,
         )
+        try:
+            snapshot_download(**download_kwargs)
+        except HfHubHTTPError:
+            # Auth/404 errors come from the Hub, not the downloader
+            raise
+        except Exception as e:
+            if not constants.HF_HUB_ENABLE_HF_TRANSFER:
+                raise
+            print(f"\n⚠️  hf_transfer download failed ({e}), retrying without it...")
+            snapshot_download_without_hf_transfer(download_kwargs)
         
         print(f"\n✓ Model downloaded successfully!")
         print(f"  Location: {output_path.absolute()}")
         
-        # Verify model can be loaded
+        # Verify model files
         print("\n[2/3] Verifying model files...")
-        tokenizer = AutoTokenizer.from_pretrained(
-            str(output_path),
-            token=token,
-            local_files_only=True
-        )
-        print(f"✓ Tokenizer loaded (vocab size: {len(tokenizer)})")
-        
-        # Just verify config without loading full model (saves time)
-        from transformers import AutoConfig
-        config = AutoConfig.from_pretrained(
-            str(output_path),
-            token=token,
-            local_files_only=True
-        )
+        config = verify_model_files(output_path)
         print(f"✓ Model config verified")
-        print(f"  Architecture: {config.model_type}")
+        print(f"  Architecture: {config['model_type']}")
         
         # Try to display parameter count if available
-        if hasattr(config, 'num_parameters'):
-            print(f"  Parameters: ~{config.num_parameters // 1_000_000_000}B")
-        elif hasattr(config, 'hidden_size') and hasattr(config, 'num_hidden_layers'):
+        if 'num_parameters' in config:
+            print(f"  Parameters: ~{config['num_parameters'] // 1_000_000_000}B")
+        elif 'hidden_size' in config and 'num_hidden_layers' in config:
             # Rough estimate for transformer models
-            params_estimate = config.hidden_size * config.num_hidden_layers * 12 * config.hidden_size / 1_000_000_000
+            params_estimate = config['hidden_size'] * config['num_hidden_layers'] * 12 * config['hidden_size'] / 1_000_000_000
             print(f"  Parameters: ~{params_estimate:.1f}B (estimated)")
         
+        if verify_strict:
+            # Full round-trip through transformers (parses tokenizer.json, slow)
+            from transformers import AutoTokenizer
+            tokenizer = AutoTokenizer.from_pretrained(
+                str(output_path),
+                token=token,
+                local_files_only=True
+            )
+            print(f"✓ Tokenizer loaded (vocab size: {len(tokenizer)})")
+        
         print("\n[3/3] Model ready for use!")
         print(f"\nNext steps:")
         print(f"  1. cd phase1-bare-metal")
@@ -156,12 +229,18 @@ Examples:
         help='HuggingFace access token (or set HF_TOKEN env var)'
     )
     
+    parser.add_argument(
+        '--verify-strict',
+        action='store_true',
+        help='Also load the tokenizer with transformers after downloading (slower)'
+    )
+    
     args = parser.parse_args()
     
     # Check for token in environment if not provided
     token = args.token or os.getenv('HF_TOKEN')
     
-    success = download_model(args.model, args.output, token)
+    success = download_model(args.model, args.output, token, verify_strict=args.verify_strict)
     sys.exit(0 if success else 1)
 
 
@@ -7,210 +7,364 @@ for running the LLM inference tutorial.
 
 Usage:
     python3 gpu_check.py
+    python3 gpu_check.py --no-cache   # ignore cached driver results
+    python3 gpu_check.py --thorough   # also start a test CUDA container
 """
 
-import subprocess
+import argparse
+import hashlib
+import os
+import re
 import sys
 import json
-from typing import Dict, List, Tuple
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from importlib.util import find_spec
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
 
+from _common import Colors, run_command
 
-class Colors:
-    """ANSI color codes for terminal output"""
-    GREEN = '\033[92m'
-    RED = '\033[91m'
-    YELLOW = '\033[93m'
-    BLUE = '\033[94m'
-    BOLD = '\033[1m'
-    END = '\033[0m'
+try:
+    import pynvml
+except ImportError:
+    pynvml = None
 
 
-def run_command(cmd: List[str]) -> Tuple[bool, str]:
-    """Run a shell command and return success status and output"""
-    try:
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            timeout=10
-        )
-        return result.returncode == 0, result.stdout.strip()
-    except (subprocess.TimeoutExpired, FileNotFoundError):
-        return False, ""
+# CUDA driver version, parsed from the `nvidia-smi --version` output that
+# check_nvidia_smi already collects so nvidia-smi isn't started again for it
+_CUDA_VERSION: Optional[str] = None
+
+# "CUDA Version: 12.2" (nvidia-smi banner) or "CUDA Version : 12.2" (--version)
+_CUDA_VER_RE = re.compile(r'CUDA Version\s*:\s*(\d+(?:\.\d+)+)')
+# The "Cuda compilation tools, release 12.2, V12.2.140" line of nvcc --version
+_NVCC_RELEASE_RE = re.compile(r'^.*release\s+(\d+(?:\.\d+)+).*$', re.IGNORECASE | re.MULTILINE)
+
+# NVML is initialized at most once; None until tried, then True/False
+_NVML_READY: Optional[bool] = None
+
+
+class ResultCache:
+    """
+    Command outputs that only change on a driver or kernel upgrade,
+    persisted between runs. Entries expire after ttl seconds and the whole
+    file is dropped when the driver version or kernel release changes.
+    """
+    
+    PATH = Path.home() / '.cache' / 'runai-tutorial' / 'gpu_check.json'
+    TTL = 24 * 3600
+    
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.fingerprint = self._fingerprint()
+        self.entries = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+        if enabled:
+            try:
+                data = json.loads(self.PATH.read_text())
+                if data.get('fingerprint') == self.fingerprint:
+                    self.entries = data.get('entries', {})
+            except (OSError, ValueError):
+                pass
+    
+    @staticmethod
+    def _fingerprint() -> str:
+        digest = hashlib.sha256(os.uname().release.encode())
+        try:
+            digest.update(Path('/proc/driver/nvidia/version').read_bytes())
+        except OSError:
+            pass
+        return digest.hexdigest()
+    
+    def get(self, key: str) -> Optional[str]:
+        with self.lock:
+            entry = self.entries.get(key)
+        if not self.enabled or entry is None or time.time() - entry['time'] > self.TTL:
+            return None
+        return entry['output']
+    
+    def put(self, key: str, output: str):
+        with self.lock:
+            self.entries[key] = {'output': output, 'time': time.time()}
+            self.dirty = True
+    
+    def save(self):
+        if not self.dirty:
+            return
+        try:
+            self.PATH.parent.mkdir(parents=True, exist_ok=True)
+            self.PATH.write_text(json.dumps({'fingerprint': self.fingerprint, 'entries': self.entries}))
+        except OSError:
+            pass
+
+
+_cache = ResultCache(enabled=False)
+
+
+def run_cached(key: str, cmd: List[str]) -> Tuple[bool, str, bool]:
+    """run_command, reusing a cached successful output; also returns whether it was a hit"""
+    output = _cache.get(key)
+    if output is not None:
+        return True, output, True
+    success, output = run_command(cmd)
+    if success:
+        _cache.put(key, output)
+    return success, output, False
 
 
-def check_nvidia_smi() -> bool:
-    """Check if nvidia-smi is available"""
-    print(f"\n{Colors.BOLD}[1/7] Checking nvidia-smi...{Colors.END}")
-    success, output = run_command(['nvidia-smi', '--version'])
+def nvml_available() -> bool:
+    """Initialize NVML in-process (nvidia-ml-py) on first use"""
+    global _NVML_READY
+    if _NVML_READY is None:
+        _NVML_READY = False
+        if pynvml is not None:
+            try:
+                pynvml.nvmlInit()
+                _NVML_READY = True
+            except pynvml.NVMLError:
+                pass
+    return _NVML_READY
+
+
+def check_nvidia_smi() -> Tuple[bool, List[str]]:
+    """Check if the NVIDIA driver is reachable (NVML, else nvidia-smi)"""
+    global _CUDA_VERSION
+    lines = []
+    lines.append(f"\n{Colors.BOLD}[1/7] Checking nvidia-smi...{Colors.END}")
+    
+    if nvml_available():
+        try:
+            # Returns e.g. 12020 for CUDA 12.2
+            cuda = pynvml.nvmlSystemGetCudaDriverVersion_v2()
+        except pynvml.NVMLError:
+            # e.g. FunctionNotFound on older drivers; nvidia-smi reports it instead
+            pass
+        else:
+            _CUDA_VERSION = f"{cuda // 1000}.{cuda % 1000 // 10}"
+            lines.append(f"{Colors.GREEN}✓ NVIDIA driver found (NVML){Colors.END}")
+            return True, lines
+    
+    success, output, _ = run_cached('nvidia_smi_version', ['nvidia-smi', '--version'])
     
     if success:
-        print(f"{Colors.GREEN}✓ nvidia-smi found{Colors.END}")
-        return True
+        cuda_match = _CUDA_VER_RE.search(output)
+        if cuda_match:
+            _CUDA_VERSION = cuda_match.group(1)
+        lines.append(f"{Colors.GREEN}✓ nvidia-smi found{Colors.END}")
+        return True, lines
     else:
-        print(f"{Colors.RED}✗ nvidia-smi not found{Colors.END}")
-        print(f"{Colors.YELLOW}  → Install NVIDIA drivers: https://www.nvidia.com/download/index.aspx{Colors.END}")
-        return False
+        lines.append(f"{Colors.RED}✗ nvidia-smi not found{Colors.END}")
+        lines.append(f"{Colors.YELLOW}  → Install NVIDIA drivers: https://www.nvidia.com/download/index.aspx{Colors.END}")
+        return False, lines
 
 
-def check_gpu_details() -> Dict:
-    """Get GPU details using nvidia-smi"""
-    print(f"\n{Colors.BOLD}[2/7] Checking GPU details...{Colors.END}")
-    
+def query_gpu_nvml() -> Optional[Tuple[str, float, str]]:
+    """Name, memory (GB) and driver version of GPU 0 via NVML"""
+    if not nvml_available():
+        return None
+    try:
+        handle = pynvml.nvmlDeviceGetHandleByIndex(0)
+        name = pynvml.nvmlDeviceGetName(handle)
+        driver_version = pynvml.nvmlSystemGetDriverVersion()
+        memory_gb = pynvml.nvmlDeviceGetMemoryInfo(handle).total / 1024**3
+    except pynvml.NVMLError:
+        return None
+    # Older nvidia-ml-py releases return bytes
+    if isinstance(name, bytes):
+        name = name.decode()
+    if isinstance(driver_version, bytes):
+        driver_version = driver_version.decode()
+    return name, memory_gb, driver_version
+
+
+def query_gpu_nvidia_smi() -> Optional[Tuple[str, float, str]]:
+    """Name, memory (GB) and driver version of GPU 0 via nvidia-smi"""
     # Query GPU details (without cuda_version which is not a valid field)
     success, output = run_command([
         'nvidia-smi',
         '--query-gpu=name,memory.total,driver_version',
-        '--format=csv,noheader'
+        '--format=csv,noheader,nounits'
     ])
     
     if not success:
-        print(f"{Colors.RED}✗ Could not query GPU details{Colors.END}")
-        return {}
-    
-    # Parse output (format: "GPU Name, 24576 MiB, 535.129.03")
-    parts = output.split(',')
-    if len(parts) >= 3:
-        gpu_name = parts[0].strip()
-        memory_str = parts[1].strip()
-        driver_version = parts[2].strip()
-        
-        # Extract memory in MB
-        memory_mb = int(memory_str.split()[0])
-        memory_gb = memory_mb / 1024
-        
-        # Get CUDA version separately from nvidia-smi output
-        cuda_version = "N/A"
+        return None
+    
+    # Parse output (format: "GPU Name, 24576, 535.129.03", memory in MiB; first GPU)
+    parts = output.splitlines()[0].split(',')
+    if len(parts) < 3:
+        return None
+    return parts[0].strip(), int(parts[1]) / 1024, parts[2].strip()
+
+
+def check_gpu_details() -> Tuple[Dict, List[str]]:
+    """Get GPU details using NVML, falling back to nvidia-smi"""
+    lines = []
+    lines.append(f"\n{Colors.BOLD}[2/7] Checking GPU details...{Colors.END}")
+    
+    details = query_gpu_nvml() or query_gpu_nvidia_smi()
+    if details is None:
+        lines.append(f"{Colors.RED}✗ Could not query GPU details{Colors.END}")
+        return {}, lines
+    gpu_name, memory_gb, driver_version = details
+    
+    # Older drivers don't print the CUDA version with --version; only
+    # then fall back to the full nvidia-smi banner
+    cuda_version = _CUDA_VERSION or "N/A"
+    if _CUDA_VERSION is None:
         cuda_success, cuda_output = run_command(['nvidia-smi'])
         if cuda_success:
-            import re
-            cuda_match = re.search(r'CUDA Version:\s+(\d+\.\d+)', cuda_output)
+            cuda_match = _CUDA_VER_RE.search(cuda_output)
             if cuda_match:
                 cuda_version = cuda_match.group(1)
-        
-        print(f"{Colors.GREEN}✓ GPU detected{Colors.END}")
-        print(f"  Name: {Colors.BLUE}{gpu_name}{Colors.END}")
-        print(f"  Memory: {Colors.BLUE}{memory_gb:.1f} GB{Colors.END}")
-        print(f"  Driver: {Colors.BLUE}{driver_version}{Colors.END}")
-        print(f"  CUDA: {Colors.BLUE}{cuda_version}{Colors.END}")
-        
-        # Check if memory is sufficient (10GB minimum for Llama 3.2 3B)
-        if memory_gb < 10:
-            print(f"{Colors.YELLOW}  ⚠ Warning: GPU has less than 10GB VRAM{Colors.END}")
-            print(f"{Colors.YELLOW}  → Consider using Phi-3 Mini with quantization{Colors.END}")
-        
-        return {
-            'name': gpu_name,
-            'memory_gb': memory_gb,
-            'driver_version': driver_version,
-            'cuda_version': cuda_version
-        }
     
-    return {}
+    lines.append(f"{Colors.GREEN}✓ GPU detected{Colors.END}")
+    lines.append(f"  Name: {Colors.BLUE}{gpu_name}{Colors.END}")
+    lines.append(f"  Memory: {Colors.BLUE}{memory_gb:.1f} GB{Colors.END}")
+    lines.append(f"  Driver: {Colors.BLUE}{driver_version}{Colors.END}")
+    lines.append(f"  CUDA: {Colors.BLUE}{cuda_version}{Colors.END}")
+    
+    # Check if memory is sufficient (10GB minimum for Llama 3.2 3B)
+    if memory_gb < 10:
+        lines.append(f"{Colors.YELLOW}  ⚠ Warning: GPU has less than 10GB VRAM{Colors.END}")
+        lines.append(f"{Colors.YELLOW}  → Consider using Phi-3 Mini with quantization{Colors.END}")
+    
+    return {
+        'name': gpu_name,
+        'memory_gb': memory_gb,
+        'driver_version': driver_version,
+        'cuda_version': cuda_version
+    }, lines
 
 
-def check_cuda_compiler() -> bool:
+def check_cuda_compiler() -> Tuple[bool, List[str]]:
     """Check if NVCC (CUDA compiler) is available"""
-    print(f"\n{Colors.BOLD}[3/7] Checking CUDA compiler (nvcc)...{Colors.END}")
+    lines = []
+    lines.append(f"\n{Colors.BOLD}[3/7] Checking CUDA compiler (nvcc)...{Colors.END}")
     
+    # Not cached: the fingerprint doesn't cover toolkit upgrades, and it's a cheap local exec
     success, output = run_command(['nvcc', '--version'])
     
     if success:
-        # Extract CUDA version from output
-        for line in output.split('\n'):
-            if 'release' in line.lower():
-                print(f"{Colors.GREEN}✓ NVCC found{Colors.END}")
-                print(f"  {Colors.BLUE}{line.strip()}{Colors.END}")
-                return True
-        print(f"{Colors.GREEN}✓ NVCC found{Colors.END}")
-        return True
+        lines.append(f"{Colors.GREEN}✓ NVCC found{Colors.END}")
+        # Show the release line, which carries the toolkit version
+        release_match = _NVCC_RELEASE_RE.search(output)
+        if release_match:
+            lines.append(f"  {Colors.BLUE}{release_match.group(0).strip()}{Colors.END}")
+        return True, lines
     else:
-        print(f"{Colors.YELLOW}⚠ NVCC not found (optional for runtime){Colors.END}")
-        print(f"{Colors.YELLOW}  → CUDA Toolkit not required for inference, only for development{Colors.END}")
-        return False
+        lines.append(f"{Colors.YELLOW}⚠ NVCC not found (optional for runtime){Colors.END}")
+        lines.append(f"{Colors.YELLOW}  → CUDA Toolkit not required for inference, only for development{Colors.END}")
+        return False, lines
 
 
-def check_docker() -> bool:
+def check_docker() -> Tuple[bool, List[str]]:
     """Check if Docker is installed"""
-    print(f"\n{Colors.BOLD}[4/7] Checking Docker...{Colors.END}")
+    lines = []
+    lines.append(f"\n{Colors.BOLD}[4/7] Checking Docker...{Colors.END}")
     
     success, output = run_command(['docker', '--version'])
     
     if success:
-        print(f"{Colors.GREEN}✓ Docker found{Colors.END}")
-        print(f"  {Colors.BLUE}{output}{Colors.END}")
-        return True
+        lines.append(f"{Colors.GREEN}✓ Docker found{Colors.END}")
+        lines.append(f"  {Colors.BLUE}{output}{Colors.END}")
+        return True, lines
     else:
-        print(f"{Colors.RED}✗ Docker not found{Colors.END}")
-        print(f"{Colors.YELLOW}  → Install Docker: https://docs.docker.com/get-docker/{Colors.END}")
-        return False
+        lines.append(f"{Colors.RED}✗ Docker not found{Colors.END}")
+        lines.append(f"{Colors.YELLOW}  → Install Docker: https://docs.docker.com/get-docker/{Colors.END}")
+        return False, lines
 
 
-def check_docker_nvidia_runtime() -> bool:
+def check_docker_nvidia_runtime(thorough: bool = False) -> Tuple[bool, List[str]]:
     """Check if NVIDIA Container Toolkit is installed"""
-    print(f"\n{Colors.BOLD}[5/7] Checking NVIDIA Container Toolkit...{Colors.END}")
-    
-    # Try to run a simple NVIDIA container
-    success, output = run_command([
-        'docker', 'run', '--rm', '--gpus', 'all',
-        'nvidia/cuda:12.2.0-base-ubuntu22.04',
-        'nvidia-smi', '-L'
-    ])
+    lines = []
+    lines.append(f"\n{Colors.BOLD}[5/7] Checking NVIDIA Container Toolkit...{Colors.END}")
+    
+    if thorough:
+        # Try to run a simple NVIDIA container (always; the user asked for it)
+        success, output = run_command([
+            'docker', 'run', '--rm', '--gpus', 'all',
+            'nvidia/cuda:12.2.0-base-ubuntu22.04',
+            'nvidia-smi', '-L'
+        ])
+    elif not Path('/proc/driver/nvidia/version').exists():
+        # `docker run --gpus` needs the kernel driver loaded on the host
+        success, output = False, "NVIDIA kernel driver not loaded (no /proc/driver/nvidia/version)"
+    else:
+        # The toolkit's own CLI enumerates the GPUs the same way the container
+        # hook does, without pulling or starting an image
+        success, output = run_command(['nvidia-container-cli', 'info'])
     
     if success:
-        print(f"{Colors.GREEN}✓ NVIDIA Container Toolkit working{Colors.END}")
-        print(f"  {Colors.BLUE}{output.split(chr(10))[0]}{Colors.END}")
-        return True
+        lines.append(f"{Colors.GREEN}✓ NVIDIA Container Toolkit working{Colors.END}")
+        lines.append(f"  {Colors.BLUE}{output.split(chr(10))[0]}{Colors.END}")
+        if not thorough:
+            lines.append(f"  → Run with --thorough to start a test CUDA container")
+        return True, lines
     else:
-        print(f"{Colors.RED}✗ NVIDIA Container Toolkit not working{Colors.END}")
-        print(f"{Colors.YELLOW}  → Install: https://docs.nvidia.com/datacenter/cloud-native/container-toolkit/install-guide.html{Colors.END}")
-        return False
+        lines.append(f"{Colors.RED}✗ NVIDIA Container Toolkit not working{Colors.END}")
+        if not thorough and output:
+            lines.append(f"{Colors.YELLOW}  {output}{Colors.END}")
+        lines.append(f"{Colors.YELLOW}  → Install: https://docs.nvidia.com/datacenter/cloud-native/container-toolkit/install-guide.html{Colors.END}")
+        return False, lines
 
 
-def check_kubectl() -> bool:
+def check_kubectl() -> Tuple[bool, List[str]]:
     """Check if kubectl is installed (for Phase 2 & 3)"""
-    print(f"\n{Colors.BOLD}[6/7] Checking kubectl (for Phase 2 & 3)...{Colors.END}")
+    lines = []
+    lines.append(f"\n{Colors.BOLD}[6/7] Checking kubectl (for Phase 2 & 3)...{Colors.END}")
     
     success, output = run_command(['kubectl', 'version', '--client', '--short'])
     
     if success:
-        print(f"{Colors.GREEN}✓ kubectl found{Colors.END}")
+        lines.append(f"{Colors.GREEN}✓ kubectl found{Colors.END}")
         # Try to get cluster info
         cluster_success, _ = run_command(['kubectl', 'cluster-info'])
         if cluster_success:
-            print(f"{Colors.GREEN}✓ Kubernetes cluster accessible{Colors.END}")
+            lines.append(f"{Colors.GREEN}✓ Kubernetes cluster accessible{Colors.END}")
         else:
-            print(f"{Colors.YELLOW}⚠ kubectl found but cluster not accessible{Colors.END}")
-            print(f"{Colors.YELLOW}  → Configure kubectl or skip to Phase 1 only{Colors.END}")
-        return True
+            lines.append(f"{Colors.YELLOW}⚠ kubectl found but cluster not accessible{Colors.END}")
+            lines.append(f"{Colors.YELLOW}  → Configure kubectl or skip to Phase 1 only{Colors.END}")
+        return True, lines
     else:
-        print(f"{Colors.YELLOW}⚠ kubectl not found (required for Phase 2 & 3){Colors.END}")
-        print(f"{Colors.YELLOW}  → Install: https://kubernetes.io/docs/tasks/tools/{Colors.END}")
-        return False
+        lines.append(f"{Colors.YELLOW}⚠ kubectl not found (required for Phase 2 & 3){Colors.END}")
+        lines.append(f"{Colors.YELLOW}  → Install: https://kubernetes.io/docs/tasks/tools/{Colors.END}")
+        return False, lines
 
 
-def check_python_packages() -> bool:
+def check_python_packages() -> Tuple[bool, List[str]]:
     """Check if required Python packages are available"""
-    print(f"\n{Colors.BOLD}[7/7] Checking Python packages...{Colors.END}")
+    lines = []
+    lines.append(f"\n{Colors.BOLD}[7/7] Checking Python packages...{Colors.END}")
     
-    required_packages = ['torch', 'transformers', 'fastapi', 'uvicorn']
+    # numpy and aiohttp are used by load_test.py and runai_metrics.py
+    required_packages = ['torch', 'transformers', 'fastapi', 'uvicorn', 'numpy', 'aiohttp']
     missing_packages = []
     
+    # find_spec only locates the package; importing torch would initialize it
     for package in required_packages:
-        try:
-            __import__(package)
-            print(f"{Colors.GREEN}✓ {package} installed{Colors.END}")
-        except ImportError:
-            print(f"{Colors.YELLOW}⚠ {package} not installed{Colors.END}")
+        if find_spec(package) is not None:
+            lines.append(f"{Colors.GREEN}✓ {package} installed{Colors.END}")
+        else:
+            lines.append(f"{Colors.YELLOW}⚠ {package} not installed{Colors.END}")
             missing_packages.append(package)
     
     if missing_packages:
-        print(f"\n{Colors.YELLOW}Install missing packages:{Colors.END}")
-        print(f"  pip install {' '.join(missing_packages)}")
-        print(f"  or use the Dockerfiles provided in each phase")
-        return False
+        lines.append(f"\n{Colors.YELLOW}Install missing packages:{Colors.END}")
+        lines.append(f"  pip install {' '.join(missing_packages)}")
+        lines.append(f"  or use the Dockerfiles provided in each phase")
+        return False, lines
     
-    return True
+    return True, lines
+
+
+def run_after(dependency: Future, check: Callable, skipped) -> Tuple:
+    """Run check only if the dependency check passed, else return skipped"""
+    if not dependency.result()[0]:
+        return skipped, []
+    return check()
 
 
 def print_summary(results: Dict[str, bool], gpu_info: Dict):
@@ -270,27 +424,51 @@ def print_summary(results: Dict[str, bool], gpu_info: Dict):
 
 def main():
     """Main execution"""
-    print(f"\n{Colors.BOLD}{Colors.BLUE}NVIDIA Run:AI Tutorial - GPU Environment Check{Colors.END}\n")
-    
-    results = {}
-    gpu_info = {}
-    
-    # Run all checks
-    results['nvidia_smi'] = check_nvidia_smi()
-    
-    if results['nvidia_smi']:
-        gpu_info = check_gpu_details()
+    global _cache
+    parser = argparse.ArgumentParser(description="Check the GPU environment for the tutorial")
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help=f"Re-run every check instead of reusing results cached in {ResultCache.PATH}"
+    )
+    parser.add_argument(
+        '--thorough',
+        action='store_true',
+        help="Verify the container toolkit by running a CUDA container (pulls nvidia/cuda)"
+    )
+    args = parser.parse_args()
+    _cache = ResultCache(enabled=not args.no_cache)
     
-    results['cuda_compiler'] = check_cuda_compiler()
-    results['docker'] = check_docker()
-    
-    if results['docker']:
-        results['nvidia_docker'] = check_docker_nvidia_runtime()
-    else:
-        results['nvidia_docker'] = False
+    print(f"\n{Colors.BOLD}{Colors.BLUE}NVIDIA Run:AI Tutorial - GPU Environment Check{Colors.END}\n")
     
-    results['kubectl'] = check_kubectl()
-    results['python_packages'] = check_python_packages()
+    # Checks are subprocess-bound (docker dominates), so run them
+    # side by side. Each returns its output lines, printed in order below.
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        futures = {}
+        futures['nvidia_smi'] = pool.submit(check_nvidia_smi)
+        futures['gpu_details'] = pool.submit(
+            run_after, futures['nvidia_smi'], check_gpu_details, {}
+        )
+        futures['cuda_compiler'] = pool.submit(check_cuda_compiler)
+        futures['docker'] = pool.submit(check_docker)
+        futures['nvidia_docker'] = pool.submit(
+            run_after, futures['docker'], partial(check_docker_nvidia_runtime, args.thorough), False
+        )
+        futures['kubectl'] = pool.submit(check_kubectl)
+        
+        results = {}
+        for name, future in futures.items():
+            result, lines = future.result()
+            for line in lines:
+                print(line)
+            results[name] = result
+    
+    results['python_packages'], lines = check_python_packages()
+    for line in lines:
+        print(line)
+    
+    gpu_info = results.pop('gpu_details')
+    _cache.save()
     
     # Print summary
     print_summary(results, gpu_info)
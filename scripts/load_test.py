@@ -4,6 +4,9 @@ Load Testing Script for LLM Inference API
 
 Generates concurrent requests to measure throughput, latency, and GPU utilization.
 
+Requires aiohttp and numpy (orjson is used when installed):
+    pip install aiohttp numpy orjson
+
 Usage:
     python3 load_test.py --url http://localhost:8000/generate --concurrency 5 --requests 50
 """
@@ -12,28 +15,50 @@ import argparse
 import asyncio
 import aiohttp
 import time
-import statistics
-from typing import List, Dict
-import json
+import numpy as np
+from typing import Dict, Iterator, List, Tuple
 from datetime import datetime
 
+from _common import Colors, json_dumps, json_loads, write_json, write_jsonl
 
-class Colors:
-    GREEN = '\033[92m'
-    RED = '\033[91m'
-    YELLOW = '\033[93m'
-    BLUE = '\033[94m'
-    BOLD = '\033[1m'
-    END = '\033[0m'
+
+class RequestResults:
+    """Per-request outcomes, written straight into arrays indexed by request id"""
+    
+    def __init__(self, total_requests: int):
+        self.latency_ms = np.full(total_requests, np.nan)
+        self.tokens = np.zeros(total_requests, dtype=np.int32)
+        self.status = np.zeros(total_requests, dtype=np.uint16)  # 0 = no response
+        self.errors: Dict[int, str] = {}
+    
+    def __len__(self) -> int:
+        return len(self.status)
+    
+    @property
+    def success(self) -> np.ndarray:
+        return self.status == 200
+    
+    def records(self) -> Iterator[Dict]:
+        """One dict per request, built lazily for the detailed results file"""
+        for i in range(len(self)):
+            yield {
+                'request_id': i,
+                'success': bool(self.status[i] == 200),
+                'latency_ms': float(self.latency_ms[i]),
+                'status_code': int(self.status[i]),
+                'tokens': int(self.tokens[i]),
+                'error': self.errors.get(i)
+            }
 
 
 async def send_request(
     session: aiohttp.ClientSession,
     url: str,
     prompt: str,
-    request_id: int
-) -> Dict:
-    """Send a single inference request and measure latency"""
+    request_id: int,
+    results: RequestResults
+):
+    """Send a single inference request and record its latency in results"""
     
     payload = {
         "prompt": prompt,
@@ -41,41 +66,29 @@ async def send_request(
         "temperature": 0.7
     }
     
-    start_time = time.time()
+    start_time = time.perf_counter()
     
     try:
         async with session.post(url, json=payload, timeout=aiohttp.ClientTimeout(total=60)) as response:
-            result = await response.json()
-            end_time = time.time()
+            result = await response.json(loads=json_loads)
+            end_time = time.perf_counter()
             
-            latency = (end_time - start_time) * 1000  # Convert to ms
+            results.latency_ms[request_id] = (end_time - start_time) * 1000  # Convert to ms
+            results.status[request_id] = response.status
             
-            return {
-                'request_id': request_id,
-                'success': response.status == 200,
-                'latency_ms': latency,
-                'status_code': response.status,
-                'tokens': len(result.get('generated_text', '').split()) if 'generated_text' in result else 0,
-                'error': None
-            }
+            # Prefer the server's real token count; otherwise estimate words
+            # with one C-level scan instead of building a list with split()
+            tokens = result.get('tokens_generated')
+            if tokens is None:
+                text = result.get('generated_text', '')
+                tokens = text.count(' ') + 1 if text else 0
+            results.tokens[request_id] = tokens
     except asyncio.TimeoutError:
-        return {
-            'request_id': request_id,
-            'success': False,
-            'latency_ms': 60000,
-            'status_code': 0,
-            'tokens': 0,
-            'error': 'Timeout'
-        }
+        results.latency_ms[request_id] = 60000
+        results.errors[request_id] = 'Timeout'
     except Exception as e:
-        return {
-            'request_id': request_id,
-            'success': False,
-            'latency_ms': 0,
-            'status_code': 0,
-            'tokens': 0,
-            'error': str(e)
-        }
+        results.latency_ms[request_id] = 0
+        results.errors[request_id] = str(e)
 
 
 async def run_load_test(
@@ -83,25 +96,31 @@ async def run_load_test(
     concurrency: int,
     total_requests: int,
     prompts: List[str]
-) -> List[Dict]:
+) -> Tuple[RequestResults, float]:
     """Run load test with specified concurrency"""
     
-    results = []
+    results = RequestResults(total_requests)
     
-    async with aiohttp.ClientSession() as session:
-        # Create request queue
-        request_queue = []
-        
-        for i in range(total_requests):
-            prompt = prompts[i % len(prompts)]
-            request_queue.append(send_request(session, url, prompt, i))
+    # The connector caps in-flight requests and keeps those connections
+    # alive, so requests reuse sockets instead of reconnecting
+    connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=concurrency, ttl_dns_cache=300)
+    
+    async with aiohttp.ClientSession(connector=connector, json_serialize=json_dumps) as session:
+        # A producer feeds request ids to `concurrency` workers through a
+        # bounded queue, so only O(concurrency) requests exist at a time
+        queue = asyncio.Queue(maxsize=concurrency * 2)
         
-        # Execute requests with concurrency limit
-        semaphore = asyncio.Semaphore(concurrency)
+        async def produce():
+            for i in range(total_requests):
+                await queue.put(i)
+            for _ in range(concurrency):
+                await queue.put(None)
         
-        async def bounded_request(req):
-            async with semaphore:
-                return await req
+        async def worker():
+            while (i := await queue.get()) is not None:
+                # Only latency, status and token count are kept; the response
+                # body is dropped inside send_request
+                await send_request(session, url, prompts[i % len(prompts)], i, results)
         
         print(f"\n{Colors.BOLD}Starting load test...{Colors.END}")
         print(f"  URL: {url}")
@@ -109,83 +128,83 @@ async def run_load_test(
         print(f"  Concurrency: {concurrency}")
         print(f"  Prompts: {len(prompts)} unique\n")
         
-        start_time = time.time()
+        start_time = time.perf_counter()
         
-        # Run all requests
-        results = await asyncio.gather(*[bounded_request(req) for req in request_queue])
+        await asyncio.gather(produce(), *(worker() for _ in range(concurrency)))
         
-        end_time = time.time()
+        end_time = time.perf_counter()
         total_time = end_time - start_time
     
     return results, total_time
 
 
-def print_statistics(results: List[Dict], total_time: float):
+def print_statistics(results: RequestResults, total_time: float):
     """Calculate and print performance statistics"""
     
-    successful = [r for r in results if r['success']]
-    failed = [r for r in results if not r['success']]
+    success = results.success
+    n_successful = int(success.sum())
+    failed_ids = np.flatnonzero(~success)
     
-    if not successful:
+    if not n_successful:
         print(f"{Colors.RED}All requests failed!{Colors.END}")
-        for r in failed[:5]:
-            print(f"  Request {r['request_id']}: {r['error']}")
+        for i in failed_ids[:5]:
+            print(f"  Request {i}: {results.errors.get(int(i))}")
         return
     
-    latencies = [r['latency_ms'] for r in successful]
-    tokens_generated = [r['tokens'] for r in successful]
-    
-    # Sort for percentile calculations
-    sorted_latencies = sorted(latencies)
+    # Boolean indexing copies, so the in-place percentile below can't
+    # reorder the per-request arrays
+    latencies = results.latency_ms[success]
+    tokens_generated = results.tokens[success]
     
-    # Calculate percentiles
-    p50 = sorted_latencies[len(sorted_latencies) // 2]
-    p95 = sorted_latencies[int(len(sorted_latencies) * 0.95)]
-    p99 = sorted_latencies[int(len(sorted_latencies) * 0.99)]
+    # Interpolated percentiles (indexing a sorted list overstates p99 on small runs).
+    # NumPy selects the order statistics with an O(n) partition, not a sort;
+    # overwrite_input lets it partition in place instead of on a copy, which
+    # only reorders the array (min/max/mean below are unaffected).
+    p50, p95, p99 = (float(p) for p in np.percentile(latencies, [50, 95, 99], overwrite_input=True))
     
     print(f"\n{Colors.BOLD}{'='*60}{Colors.END}")
     print(f"{Colors.BOLD}LOAD TEST RESULTS{Colors.END}")
     print(f"{Colors.BOLD}{'='*60}{Colors.END}\n")
     
     # Success rate
-    success_rate = (len(successful) / len(results)) * 100
+    success_rate = (n_successful / len(results)) * 100
     print(f"{Colors.BOLD}Success Rate:{Colors.END}")
     print(f"  Total requests: {len(results)}")
-    print(f"  Successful: {Colors.GREEN}{len(successful)}{Colors.END}")
-    print(f"  Failed: {Colors.RED}{len(failed)}{Colors.END}")
+    print(f"  Successful: {Colors.GREEN}{n_successful}{Colors.END}")
+    print(f"  Failed: {Colors.RED}{len(failed_ids)}{Colors.END}")
     print(f"  Success rate: {Colors.GREEN}{success_rate:.1f}%{Colors.END}\n")
     
     # Latency statistics
     print(f"{Colors.BOLD}Latency (ms):{Colors.END}")
-    print(f"  Min: {Colors.BLUE}{min(latencies):.0f}{Colors.END}")
-    print(f"  Max: {Colors.BLUE}{max(latencies):.0f}{Colors.END}")
-    print(f"  Mean: {Colors.BLUE}{statistics.mean(latencies):.0f}{Colors.END}")
+    print(f"  Min: {Colors.BLUE}{latencies.min():.0f}{Colors.END}")
+    print(f"  Max: {Colors.BLUE}{latencies.max():.0f}{Colors.END}")
+    print(f"  Mean: {Colors.BLUE}{latencies.mean():.0f}{Colors.END}")
     print(f"  Median (p50): {Colors.BLUE}{p50:.0f}{Colors.END}")
     print(f"  p95: {Colors.BLUE}{p95:.0f}{Colors.END}")
     print(f"  p99: {Colors.BLUE}{p99:.0f}{Colors.END}\n")
     
     # Throughput
-    requests_per_second = len(successful) / total_time
+    requests_per_second = n_successful / total_time
     print(f"{Colors.BOLD}Throughput:{Colors.END}")
     print(f"  Total time: {Colors.BLUE}{total_time:.2f}s{Colors.END}")
     print(f"  Requests/sec: {Colors.BLUE}{requests_per_second:.2f}{Colors.END}")
     print(f"  Requests/min: {Colors.BLUE}{requests_per_second * 60:.0f}{Colors.END}\n")
     
     # Token statistics
-    if tokens_generated and sum(tokens_generated) > 0:
-        total_tokens = sum(tokens_generated)
+    total_tokens = int(tokens_generated.sum())
+    if total_tokens > 0:
         tokens_per_second = total_tokens / total_time
         print(f"{Colors.BOLD}Token Generation:{Colors.END}")
         print(f"  Total tokens: {Colors.BLUE}{total_tokens}{Colors.END}")
         print(f"  Tokens/sec: {Colors.BLUE}{tokens_per_second:.1f}{Colors.END}")
-        print(f"  Avg tokens/request: {Colors.BLUE}{statistics.mean(tokens_generated):.0f}{Colors.END}\n")
+        print(f"  Avg tokens/request: {Colors.BLUE}{tokens_generated.mean():.0f}{Colors.END}\n")
     
     # Failures
-    if failed:
+    if len(failed_ids):
         print(f"{Colors.BOLD}Failures:{Colors.END}")
         error_types = {}
-        for r in failed:
-            error = r['error'] or f"HTTP {r['status_code']}"
+        for i in failed_ids:
+            error = results.errors.get(int(i)) or f"HTTP {results.status[i]}"
             error_types[error] = error_types.get(error, 0) + 1
         
         for error, count in error_types.items():
@@ -194,33 +213,36 @@ def print_statistics(results: List[Dict], total_time: float):
     
     print(f"{Colors.BOLD}{'='*60}{Colors.END}\n")
     
-    # Save results to file
+    # Save aggregates to a small JSON file and per-request records to NDJSON,
+    # written one line at a time instead of as one big document
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     results_file = f"load_test_results_{timestamp}.json"
+    details_file = f"load_test_results_{timestamp}.jsonl"
     
     summary = {
         'timestamp': timestamp,
         'total_requests': len(results),
-        'successful': len(successful),
-        'failed': len(failed),
+        'successful': n_successful,
+        'failed': len(failed_ids),
         'success_rate': success_rate,
         'total_time_seconds': total_time,
         'requests_per_second': requests_per_second,
         'latency_ms': {
-            'min': min(latencies),
-            'max': max(latencies),
-            'mean': statistics.mean(latencies),
+            'min': float(latencies.min()),
+            'max': float(latencies.max()),
+            'mean': float(latencies.mean()),
             'p50': p50,
             'p95': p95,
             'p99': p99
         },
-        'detailed_results': results
+        'detailed_results_file': details_file
     }
     
-    with open(results_file, 'w') as f:
-        json.dump(summary, f, indent=2)
+    write_json(results_file, summary)
+    write_jsonl(details_file, results.records())
     
-    print(f"Results saved to: {Colors.BLUE}{results_file}{Colors.END}\n")
+    print(f"Results saved to: {Colors.BLUE}{results_file}{Colors.END}")
+    print(f"Per-request results: {Colors.BLUE}{details_file}{Colors.END}\n")
 
 
 def get_sample_prompts() -> List[str]:
@@ -4,27 +4,40 @@ Run:AI Metrics Collection Script
 
 Collects and analyzes Run:AI workload metrics for comparison.
 
+Requires numpy (orjson is used when installed):
+    pip install numpy orjson
+
 Usage:
     python3 runai_metrics.py --project llm-inference --duration 300
+
+    # Scrape the DCGM exporter instead of exec-ing into each pod; from a
+    # workstation, forward it first:
+    kubectl port-forward -n gpu-operator svc/nvidia-dcgm-exporter 9400 &
+    python3 runai_metrics.py --project llm-inference --dcgm-url http://localhost:9400/metrics
 """
 
 import argparse
+import re
 import subprocess
-import json
+import threading
 import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import List, Dict
-import statistics
+from typing import List, Dict, Optional
+
+import numpy as np
+
+from _common import json_loads, resolve_executable, run_command as _run_command, write_json
 
 
 def run_command(cmd: List[str]) -> str:
     """Execute shell command and return output"""
-    try:
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-        return result.stdout.strip()
-    except subprocess.CalledProcessError as e:
-        print(f"Error running command: {e}")
+    success, output = _run_command(cmd, timeout=None)
+    if not success:
+        print(f"Error running command: {' '.join(cmd)}")
         return ""
+    return output
 
 
 def get_runai_workloads(project: str) -> List[Dict]:
@@ -40,94 +53,363 @@ def get_runai_workloads(project: str) -> List[Dict]:
     if not output:
         return []
     
-    data = json.loads(output)
-    workloads = []
-    
-    for item in data.get("items", []):
-        metadata = item.get("metadata", {})
-        annotations = metadata.get("annotations", {})
-        
-        # Extract Run:AI annotations
-        gpu_fraction = annotations.get("runai.ai/gpu-fraction", "0")
-        
-        workload = {
-            "name": metadata.get("name", "unknown"),
-            "gpu_fraction": float(gpu_fraction) if gpu_fraction else 0,
-            "status": item.get("status", {}).get("phase", "Unknown"),
-            "node": item.get("spec", {}).get("nodeName", ""),
-        }
-        workloads.append(workload)
-    
-    return workloads
+    data = json_loads(output)
+    return [parse_workload(item) for item in data.get("items", [])]
+
+
+def parse_workload(item: Dict) -> Dict:
+    """Extract the fields we track from a pod object"""
+    metadata = item.get("metadata", {})
+    annotations = metadata.get("annotations", {})
+    
+    # Extract Run:AI annotations
+    gpu_fraction = annotations.get("runai.ai/gpu-fraction", "0")
+    
+    return {
+        "name": metadata.get("name", "unknown"),
+        "gpu_fraction": float(gpu_fraction) if gpu_fraction else 0,
+        "status": item.get("status", {}).get("phase", "Unknown"),
+        "node": item.get("spec", {}).get("nodeName", ""),
+    }
+
+
+class PodWatcher:
+    """
+    Live view of a namespace's pods from a single `kubectl get pods --watch`
+    stream, so each sample reads a local dict instead of re-listing every pod.
+    """
+    
+    def __init__(self, namespace: str):
+        self.namespace = namespace
+        self._pods: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+        self._process: Optional[subprocess.Popen] = None
+    
+    def start(self, workloads: List[Dict]) -> bool:
+        """Seed with a full listing and start watching; False if kubectl is missing"""
+        self._pods = {w["name"]: w for w in workloads}
+        executable = resolve_executable("kubectl")
+        if executable is None:
+            return False
+        self._process = subprocess.Popen(
+            [executable, "get", "pods", "-n", self.namespace,
+             "--watch", "--output-watch-events", "-o", "json"],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            close_fds=False
+        )
+        threading.Thread(target=self._read_events, daemon=True).start()
+        return True
+    
+    def _read_events(self):
+        # kubectl pretty-prints one JSON event after another; each ends with
+        # a closing brace in the first column
+        lines = []
+        for line in self._process.stdout:
+            lines.append(line)
+            if line.rstrip() != "}":
+                continue
+            event = json_loads("".join(lines))
+            lines.clear()
+            workload = parse_workload(event.get("object", {}))
+            with self._lock:
+                if event.get("type") == "DELETED":
+                    self._pods.pop(workload["name"], None)
+                else:
+                    self._pods[workload["name"]] = workload
+    
+    def snapshot(self) -> Optional[List[Dict]]:
+        """Current workloads, or None once the watch has exited"""
+        if self._process is None or self._process.poll() is not None:
+            return None
+        with self._lock:
+            return list(self._pods.values())
+    
+    def __enter__(self) -> "PodWatcher":
+        return self
+    
+    def __exit__(self, *exc_info):
+        if self._process is not None and self._process.poll() is None:
+            self._process.terminate()
+            self._process.wait()
+
+
+# Runs inside the pod: one NVML query instead of a cold nvidia-smi start.
+# Prints the same CSV as the nvidia-smi query below (util %, used MiB, total MiB),
+# or NO_NVML when the image has no nvidia-ml-py.
+NO_NVML = "NO_NVML"
+NVML_PROBE = (
+    "try:\n"
+    "    import pynvml\n"
+    "except ImportError:\n"
+    f"    print('{NO_NVML}'); raise SystemExit\n"
+    "pynvml.nvmlInit(); h = pynvml.nvmlDeviceGetHandleByIndex(0)\n"
+    "m = pynvml.nvmlDeviceGetMemoryInfo(h)\n"
+    "print(pynvml.nvmlDeviceGetUtilizationRates(h).gpu, m.used >> 20, m.total >> 20, sep=',')\n"
+)
+
+# kubectl exec's error when the container image has no python3
+_NO_PYTHON_RE = re.compile(r'executable file not found|exec: "python3": .*no such file or directory')
+
+# Pods whose image has no python3 or nvidia-ml-py; these go straight to nvidia-smi
+_NO_NVML_PODS = set()
+
+
+def probe_nvml(pod_name: str, namespace: str) -> str:
+    """Run NVML_PROBE in a pod; empty string if it failed (quietly, nvidia-smi is the fallback)"""
+    executable = resolve_executable("kubectl")
+    if executable is None:
+        return ""
+    result = subprocess.run(
+        [executable, "exec", "-n", namespace, pod_name, "--", "python3", "-c", NVML_PROBE],
+        stdin=subprocess.DEVNULL,
+        capture_output=True,
+        text=True,
+        close_fds=False
+    )
+    output = result.stdout.strip()
+    # Only a missing interpreter or module skips the probe for good; transient
+    # apiserver/exec errors are retried next sample
+    if output == NO_NVML or (result.returncode != 0 and _NO_PYTHON_RE.search(result.stderr)):
+        _NO_NVML_PODS.add(pod_name)
+        return ""
+    return output if result.returncode == 0 else ""
 
 
 def get_gpu_metrics(pod_name: str, namespace: str) -> Dict:
     """Get GPU metrics from a specific pod"""
-    cmd = [
-        "kubectl", "exec", "-n", namespace, pod_name, "--",
-        "nvidia-smi", "--query-gpu=utilization.gpu,memory.used,memory.total",
-        "--format=csv,noheader,nounits"
-    ]
+    output = ""
+    if pod_name not in _NO_NVML_PODS:
+        output = probe_nvml(pod_name, namespace)
     
-    output = run_command(cmd)
     if not output:
-        return {}
-    
-    parts = output.split(",")
+        output = run_command([
+            "kubectl", "exec", "-n", namespace, pod_name, "--",
+            "nvidia-smi", "--query-gpu=utilization.gpu,memory.used,memory.total",
+            "--format=csv,noheader,nounits"
+        ])
+    return parse_gpu_csv(output)
+
+
+def parse_gpu_csv(line: str) -> Dict:
+    """Parse a "util, memory used, memory total" CSV line (empty dict if malformed)"""
+    parts = line.split(",")
     if len(parts) >= 3:
-        return {
-            "gpu_util": float(parts[0].strip()),
-            "memory_used_mb": float(parts[1].strip()),
-            "memory_total_mb": float(parts[2].strip())
-        }
+        try:
+            return {
+                "gpu_util": float(parts[0].strip()),
+                "memory_used_mb": float(parts[1].strip()),
+                "memory_total_mb": float(parts[2].strip())
+            }
+        except ValueError:
+            pass
     
     return {}
 
 
-def collect_metrics(project: str, duration: int, interval: int = 5):
-    """Collect metrics over time"""
+class PodGpuSampler:
+    """
+    Streams one pod's GPU stats from a long-running `nvidia-smi --loop-ms`
+    inside the pod, so the exec and driver attach are paid once per run
+    instead of once per sample. A reader thread keeps only the latest line.
+    """
+    
+    def __init__(self, pod_name: str, namespace: str, interval_ms: int):
+        self._latest: Dict = {}
+        self._first_line = threading.Event()
+        self._process: Optional[subprocess.Popen] = None
+        
+        executable = resolve_executable("kubectl")
+        if executable is None:
+            self._first_line.set()
+            return
+        self._process = subprocess.Popen(
+            [executable, "exec", "-n", namespace, pod_name, "--",
+             "nvidia-smi", "-i", "0",
+             "--query-gpu=utilization.gpu,memory.used,memory.total",
+             "--format=csv,noheader,nounits", f"--loop-ms={interval_ms}"],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            close_fds=False
+        )
+        threading.Thread(target=self._read_lines, daemon=True).start()
+    
+    def _read_lines(self):
+        for line in self._process.stdout:
+            metrics = parse_gpu_csv(line)
+            if not metrics:
+                # e.g. [N/A] utilization under MIG/vGPU; it won't get better,
+                # so stop the stream and let samples fall back right away
+                self._process.terminate()
+                break
+            self._latest = metrics
+            self._first_line.set()
+        self._first_line.set()
+    
+    def sample(self, timeout: float = 10) -> Dict:
+        """Latest GPU stats, or an empty dict if the stream isn't running"""
+        # Only the first sample waits; a stream that stays silent (hung exec)
+        # must not hold up every later sample past the interval
+        if not self._first_line.wait(timeout):
+            self._first_line.set()
+            self.close()
+        if self._process is None or self._process.poll() is not None:
+            return {}
+        return self._latest
+    
+    def close(self):
+        if self._process is not None and self._process.poll() is None:
+            self._process.terminate()
+            self._process.wait()
+
+
+class PodGpuSamplers:
+    """A PodGpuSampler per running pod, started and stopped as pods come and go"""
+    
+    def __init__(self, namespace: str, interval_ms: int):
+        self.namespace = namespace
+        self.interval_ms = interval_ms
+        self._samplers: Dict[str, PodGpuSampler] = {}
+    
+    def sample(self, pod_names: List[str], pool: ThreadPoolExecutor) -> List[Dict]:
+        """Current GPU stats for each pod; one-shot exec where a stream isn't running"""
+        for name in set(self._samplers) - set(pod_names):
+            self._samplers.pop(name).close()
+        for name in pod_names:
+            if name not in self._samplers:
+                self._samplers[name] = PodGpuSampler(name, self.namespace, self.interval_ms)
+        
+        # First samples wait for each stream's first line, so wait in parallel
+        return list(pool.map(
+            lambda name: self._samplers[name].sample() or get_gpu_metrics(name, self.namespace),
+            pod_names
+        ))
+    
+    def __enter__(self) -> "PodGpuSamplers":
+        return self
+    
+    def __exit__(self, *exc_info):
+        for sampler in self._samplers.values():
+            sampler.close()
+        self._samplers.clear()
+
+
+# NVIDIA GPU Operator's DCGM exporter; one scrape covers every GPU pod.
+# This name only resolves inside the cluster; from outside use
+# kubectl port-forward -n gpu-operator svc/nvidia-dcgm-exporter 9400
+DCGM_EXPORTER_URL = "http://nvidia-dcgm-exporter.gpu-operator:9400/metrics"
+
+_DCGM_SAMPLE_RE = re.compile(
+    r'^(DCGM_FI_DEV_GPU_UTIL|DCGM_FI_DEV_FB_USED|DCGM_FI_DEV_FB_FREE|DCGM_FI_DEV_FB_RESERVED)'
+    r'\{([^}]*)\}\s+(\S+)',
+    re.MULTILINE
+)
+_DCGM_LABEL_RE = re.compile(r'(\w+)="([^"]*)"')
+
+
+def get_dcgm_metrics(url: str, namespace: str) -> Optional[Dict[str, Dict]]:
+    """Get GPU metrics for all pods in a namespace from the DCGM exporter (None if unreachable)"""
+    try:
+        with urllib.request.urlopen(url, timeout=5) as response:
+            text = response.read().decode()
+    except (OSError, ValueError) as e:
+        print(f"Error scraping DCGM exporter: {e}")
+        return None
+    
+    # Gauges are per GPU, labeled with the pod the GPU is attached to
+    fields_by_pod = {}
+    for name, labels, value in _DCGM_SAMPLE_RE.findall(text):
+        label_map = dict(_DCGM_LABEL_RE.findall(labels))
+        pod = label_map.get("pod")
+        if pod and label_map.get("namespace") == namespace:
+            fields_by_pod.setdefault(pod, {})[name] = float(value)
+    
+    metrics = {}
+    for pod, fields in fields_by_pod.items():
+        if "DCGM_FI_DEV_GPU_UTIL" not in fields or "DCGM_FI_DEV_FB_USED" not in fields:
+            continue
+        used = fields["DCGM_FI_DEV_FB_USED"]
+        metrics[pod] = {
+            "gpu_util": fields["DCGM_FI_DEV_GPU_UTIL"],
+            "memory_used_mb": used,
+            "memory_total_mb": used + fields.get("DCGM_FI_DEV_FB_FREE", 0) + fields.get("DCGM_FI_DEV_FB_RESERVED", 0)
+        }
+    
+    return metrics
+
+
+def collect_metrics(project: str, duration: int, interval: int = 5, dcgm_url: Optional[str] = None):
+    """Collect metrics over time (dcgm_url=None execs into each pod instead)"""
     print(f"\n{'='*60}")
     print(f"Collecting Run:AI Metrics for Project: {project}")
     print(f"Duration: {duration} seconds")
     print(f"Interval: {interval} seconds")
+    print(f"GPU metrics: {dcgm_url or 'kubectl exec'}")
     print(f"{'='*60}\n")
     
     namespace = f"runai-{project}"
     samples = []
     iterations = duration // interval
     
-    for i in range(iterations):
-        timestamp = datetime.now().isoformat()
-        print(f"[{i+1}/{iterations}] Collecting sample at {timestamp}")
+    # Pod changes stream in from one watch; re-list only if it isn't running
+    with PodWatcher(namespace) as watcher, \
+            PodGpuSamplers(namespace, interval * 1000) as gpu_samplers, \
+            ThreadPoolExecutor(max_workers=16) as pool:
+        watcher.start(get_runai_workloads(project))
         
-        # Get workloads
-        workloads = get_runai_workloads(project)
-        
-        sample = {
-            "timestamp": timestamp,
-            "workloads": workloads,
-            "gpu_metrics": []
-        }
-        
-        # Get GPU metrics from each pod
-        for workload in workloads:
-            if workload["status"] == "Running":
-                metrics = get_gpu_metrics(workload["name"], namespace)
+        # Sample on a fixed schedule so time spent collecting doesn't add drift
+        next_sample = time.monotonic()
+        for i in range(iterations):
+            timestamp = datetime.now().isoformat()
+            print(f"[{i+1}/{iterations}] Collecting sample at {timestamp}")
+            
+            # Get workloads
+            workloads = watcher.snapshot()
+            if workloads is None:
+                workloads = get_runai_workloads(project)
+            
+            sample = {
+                "timestamp": timestamp,
+                "workloads": workloads,
+                "gpu_metrics": []
+            }
+            
+            # Get GPU metrics for every pod in one scrape; pods without DCGM
+            # series (DCGM disabled or unreachable, Run:AI fractional GPUs
+            # outside the device plugin, no pod mapping) read their own
+            # streaming nvidia-smi instead
+            running = [w["name"] for w in workloads if w["status"] == "Running"]
+            dcgm_metrics = get_dcgm_metrics(dcgm_url, namespace) if dcgm_url else None
+            if dcgm_url and dcgm_metrics is None:
+                # Unreachable (or a slow DNS lookup) would cost every sample
+                print("  DCGM exporter unreachable, using kubectl exec for the rest of the run")
+                dcgm_url = None
+            dcgm_metrics = dcgm_metrics or {}
+            missing = [name for name in running if name not in dcgm_metrics]
+            fallback_metrics = dict(zip(missing, gpu_samplers.sample(missing, pool)))
+            pod_metrics = [dcgm_metrics.get(name) or fallback_metrics.get(name) for name in running]
+            
+            for name, metrics in zip(running, pod_metrics):
                 if metrics:
                     sample["gpu_metrics"].append({
-                        "pod": workload["name"],
+                        "pod": name,
                         **metrics
                     })
-        
-        samples.append(sample)
-        
-        # Print summary
-        if sample["gpu_metrics"]:
-            avg_util = statistics.mean([m["gpu_util"] for m in sample["gpu_metrics"]])
-            print(f"  Workloads: {len(workloads)} | Avg GPU Util: {avg_util:.1f}%")
-        
-        if i < iterations - 1:
-            time.sleep(interval)
+            
+            samples.append(sample)
+            
+            # Print summary
+            if sample["gpu_metrics"]:
+                avg_util = np.mean([m["gpu_util"] for m in sample["gpu_metrics"]])
+                print(f"  Workloads: {len(workloads)} | Avg GPU Util: {avg_util:.1f}%")
+            
+            if i < iterations - 1:
+                next_sample += interval
+                time.sleep(max(0, next_sample - time.monotonic()))
     
     return samples
 
@@ -142,34 +424,36 @@ def analyze_samples(samples: List[Dict]):
         print("No samples collected!")
         return
     
-    # Extract all GPU utilization values
-    all_utils = []
-    all_memory_used = []
-    all_memory_total = []
+    # Extract all GPU metrics into one preallocated (n, 3) array:
+    # utilization %, memory used MB, memory total MB
+    n_metrics = sum(len(sample["gpu_metrics"]) for sample in samples)
+    if n_metrics == 0:
+        print("No GPU metrics collected!")
+        return
     
+    gpu = np.empty((n_metrics, 3))
+    row = 0
     for sample in samples:
         for metrics in sample["gpu_metrics"]:
-            all_utils.append(metrics["gpu_util"])
-            all_memory_used.append(metrics["memory_used_mb"])
-            all_memory_total.append(metrics["memory_total_mb"])
-    
-    if not all_utils:
-        print("No GPU metrics collected!")
-        return
+            gpu[row] = (metrics["gpu_util"], metrics["memory_used_mb"], metrics["memory_total_mb"])
+            row += 1
+    utils = gpu[:, 0]
+    mean_util = float(utils.mean())
+    median_util = float(np.median(utils))
     
     # Calculate statistics
     print("GPU Utilization:")
-    print(f"  Min: {min(all_utils):.1f}%")
-    print(f"  Max: {max(all_utils):.1f}%")
-    print(f"  Mean: {statistics.mean(all_utils):.1f}%")
-    print(f"  Median: {statistics.median(all_utils):.1f}%")
+    print(f"  Min: {utils.min():.1f}%")
+    print(f"  Max: {utils.max():.1f}%")
+    print(f"  Mean: {mean_util:.1f}%")
+    print(f"  Median: {median_util:.1f}%")
     
-    if len(all_utils) > 1:
-        print(f"  Std Dev: {statistics.stdev(all_utils):.1f}%\n")
+    if n_metrics > 1:
+        print(f"  Std Dev: {utils.std(ddof=1):.1f}%\n")
     
     # Memory usage
-    avg_memory_used = statistics.mean(all_memory_used)
-    avg_memory_total = statistics.mean(all_memory_total)
+    avg_memory_used = float(gpu[:, 1].mean())
+    avg_memory_total = float(gpu[:, 2].mean())
     memory_util = (avg_memory_used / avg_memory_total) * 100
     
     print("GPU Memory:")
@@ -177,25 +461,24 @@ def analyze_samples(samples: List[Dict]):
     print(f"  Total: {avg_memory_total:.0f} MB\n")
     
     # Workload count
-    workload_counts = [len(s["workloads"]) for s in samples]
-    avg_workloads = statistics.mean(workload_counts)
+    workload_counts = np.fromiter((len(s["workloads"]) for s in samples), dtype=np.int64, count=len(samples))
+    avg_workloads = float(workload_counts.mean())
     
     print("Workloads:")
     print(f"  Average running: {avg_workloads:.1f}")
-    print(f"  Min: {min(workload_counts)}")
-    print(f"  Max: {max(workload_counts)}\n")
+    print(f"  Min: {workload_counts.min()}")
+    print(f"  Max: {workload_counts.max()}\n")
     
     # GPU fractions
-    all_fractions = []
-    for sample in samples:
-        total_fraction = sum(w["gpu_fraction"] for w in sample["workloads"])
-        all_fractions.append(total_fraction)
+    all_fractions = np.fromiter(
+        (sum(w["gpu_fraction"] for w in sample["workloads"]) for sample in samples),
+        dtype=np.float64,
+        count=len(samples)
+    )
     
-    if all_fractions:
-        avg_fraction = statistics.mean(all_fractions)
-        print("GPU Allocation:")
-        print(f"  Average total fraction: {avg_fraction:.2f}")
-        print(f"  Max total fraction: {max(all_fractions):.2f}\n")
+    print("GPU Allocation:")
+    print(f"  Average total fraction: {all_fractions.mean():.2f}")
+    print(f"  Max total fraction: {all_fractions.max():.2f}\n")
     
     # Save results
     results_file = f"runai_metrics_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
@@ -205,10 +488,10 @@ def analyze_samples(samples: List[Dict]):
         "duration": len(samples) * 5,  # Approximate
         "samples_collected": len(samples),
         "gpu_utilization": {
-            "min": min(all_utils),
-            "max": max(all_utils),
-            "mean": statistics.mean(all_utils),
-            "median": statistics.median(all_utils)
+            "min": float(utils.min()),
+            "max": float(utils.max()),
+            "mean": mean_util,
+            "median": median_util
         },
         "memory_utilization": {
             "used_mb": avg_memory_used,
@@ -217,23 +500,22 @@ def analyze_samples(samples: List[Dict]):
         },
         "workloads": {
             "average": avg_workloads,
-            "min": min(workload_counts),
-            "max": max(workload_counts)
+            "min": int(workload_counts.min()),
+            "max": int(workload_counts.max())
         },
         "detailed_samples": samples
     }
     
-    with open(results_file, 'w') as f:
-        json.dump(summary, f, indent=2)
+    write_json(results_file, summary)
     
     print(f"Results saved to: {results_file}\n")
     
     # Comparison with Phase 2 (if available)
     print("Comparison to Phase 2 (without Run:AI):")
     print("  Phase 2 GPU Util: ~15-20% (typical)")
-    print(f"  Phase 3 GPU Util: {statistics.mean(all_utils):.1f}% (your result)")
+    print(f"  Phase 3 GPU Util: {mean_util:.1f}% (your result)")
     
-    improvement = (statistics.mean(all_utils) - 17.5) / 17.5 * 100
+    improvement = (mean_util - 17.5) / 17.5 * 100
     print(f"  Improvement: {improvement:+.1f}%")
     
     if improvement > 200:
@@ -272,10 +554,26 @@ def main():
         help='Sampling interval in seconds (default: 5)'
     )
     
+    parser.add_argument(
+        '--dcgm-url',
+        type=str,
+        default=None,
+        help=f'Scrape GPU metrics from this DCGM exporter endpoint, e.g. {DCGM_EXPORTER_URL} '
+             'in-cluster or http://localhost:9400/metrics via kubectl port-forward '
+             '(default: exec into each pod)'
+    )
+    
+    parser.add_argument(
+        '--kubectl-exec',
+        action='store_true',
+        help='Query GPUs by exec-ing into each pod even if --dcgm-url is set'
+    )
+    
     args = parser.parse_args()
     
     # Collect metrics
-    samples = collect_metrics(args.project, args.duration, args.interval)
+    dcgm_url = None if args.kubectl_exec else args.dcgm_url
+    samples = collect_metrics(args.project, args.duration, args.interval, dcgm_url)
     
     # Analyze
     analyze_samples(samples)